@@ -0,0 +1,419 @@
+"""ImageAnalyzerのスループットを計測するベンチマーク
+
+実際のGPUやモデルを使わず、/api/tags・/api/show・/api/generate を模したローカルの
+疑似Ollamaサーバーと合成画像を使って process_directory を端から端まで実行する。
+
+    python benchmark.py                      # 全シナリオを実行
+    python benchmark.py --scenario concurrent4 --images 200 --latency 0.5
+    python benchmark.py --output result.json # 結果を保存
+    python benchmark.py --compare result.json  # 保存した結果（別のコミット）と比較
+    python benchmark.py --check-cleaner        # 応答のクリーニング結果を期待出力と照合
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 疑似サーバーが返す文章の材料
+WORDS = ("a cat sitting on a wooden table near a bright window with soft light "
+         "and green plants in the background while a dog sleeps nearby").split()
+
+# 合成画像の形式と拡張子（--corpusからコピーする画像の判定にも使う）
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp"}
+IMAGE_EXTENSIONS = set(EXTENSIONS.values()) | {".jpeg"}
+
+# 応答のクリーニング結果を照合する入力と期待出力
+GOLDEN_PATH = Path(__file__).with_name("clean_response_golden.json")
+
+# シナリオ名とImageAnalyzerに渡す設定（endpointsは起動する疑似サーバーの台数）
+SCENARIOS = {
+    "sequential": {"analyzer": {"max_workers": 1}},
+    "concurrent4": {"analyzer": {"max_workers": 4}},
+    "concurrent4_prefetch": {"analyzer": {"max_workers": 4, "prefetch_count": 8}},
+    "resize_jpeg": {"analyzer": {"max_workers": 4, "max_image_edge": 1024, "image_format": "JPEG"}},
+    "streaming": {"analyzer": {"max_workers": 4, "stream": True}},
+    "multi_profile": {"analyzer": {"max_workers": 4, "profiles": [{"name": "en"}, {"name": "ja", "use_japanese": True}]}},
+    "multi_endpoint": {"analyzer": {"max_workers": 8}, "endpoints": 2},
+    "flaky": {"analyzer": {"max_workers": 4}, "server": {"failure_rate": 0.1}},
+}
+
+
+class FakeOllamaServer:
+    """Ollamaの代わりに応答する疑似サーバー（遅延・応答サイズ・失敗率を設定できる）"""
+
+    def __init__(self, port=0, latency=0.2, jitter=0.05, first_token_latency=0.05,
+                 tokens=60, failure_rate=0.0, parallel=4, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token_latency = first_token_latency
+        self.tokens = tokens
+        self.failure_rate = failure_rate
+        # OLLAMA_NUM_PARALLELと同様に、同時に生成できるリクエスト数を制限する
+        self.slots = threading.Semaphore(parallel)
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _uniform(self, low, high):
+        with self.random_lock:
+            return self.random.uniform(low, high)
+
+    def _text(self):
+        with self.random_lock:
+            words = [self.random.choice(WORDS) for _ in range(self.tokens)]
+        # 10語ごとに文を区切り、実際のキャプションに近い形にする
+        sentences = [" ".join(words[i:i + 10]).capitalize() + "." for i in range(0, len(words), 10)]
+        return " ".join(sentences)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _read_body(self):
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    data = b""
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            break
+                        data += self.rfile.read(size)
+                        self.rfile.readline()
+                else:
+                    data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                return json.loads(data) if data else {}
+
+            def _send_json(self, obj, status=200):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _write_chunk(self, obj):
+                data = (json.dumps(obj) + "\n").encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self._send_json({"models": [{"name": "benchmark"}]})
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                request = self._read_body()
+                if self.path == "/api/show":
+                    return self._send_json({"details": {"family": "benchmark"}})
+                if self.path not in ("/api/generate", "/api/chat"):
+                    return self._send_json({"error": "not found"}, 404)
+                # 画像もプロンプトも無いリクエストはモデルの読み込み（ウォームアップ）
+                if not request.get("images") and not request.get("prompt") and not request.get("messages"):
+                    return self._send_json({"model": request.get("model"), "response": "", "done": True})
+
+                server.requests += 1
+                with server.slots:
+                    if server._uniform(0, 1) < server.failure_rate:
+                        server.failures += 1
+                        return self._send_json({"error": "simulated failure"}, 500)
+                    total = max(0.0, server.latency + server._uniform(-server.jitter, server.jitter))
+                    text = server._text()
+                    stats = {
+                        "done": True,
+                        "total_duration": int(total * 1e9),
+                        "load_duration": 1000000,
+                        "prompt_eval_duration": int(server.first_token_latency * 1e9),
+                        "eval_count": server.tokens,
+                        "eval_duration": int(max(total - server.first_token_latency, 1e-3) * 1e9),
+                    }
+                    chat = self.path == "/api/chat"
+                    if not request.get("stream", True):
+                        time.sleep(total)
+                        if chat:
+                            return self._send_json(dict(stats, message={"role": "assistant", "content": text}))
+                        return self._send_json(dict(stats, response=text))
+
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    time.sleep(server.first_token_latency)
+                    pieces = text.split(" ")
+                    per_token = max(total - server.first_token_latency, 0) / len(pieces)
+                    try:
+                        for piece in pieces:
+                            content = piece + " "
+                            if chat:
+                                self._write_chunk({"message": {"role": "assistant", "content": content}, "done": False})
+                            else:
+                                self._write_chunk({"response": content, "done": False})
+                            time.sleep(per_token)
+                        self._write_chunk(stats)
+                        self.wfile.write(b"0\r\n\r\n")
+                    except (BrokenPipeError, ConnectionResetError):
+                        # クライアントが打ち切った場合
+                        pass
+
+        return Handler
+
+
+def generate_corpus(directory, count, sizes=((640, 480), (1920, 1080), (4000, 3000)),
+                    formats=("JPEG", "PNG", "WEBP"), seed=0):
+    """サイズと形式の異なる合成画像を作成する（ノイズを含めてエンコード負荷を現実に近づける）"""
+    from PIL import Image
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    noise_tile = Image.effect_noise((256, 256), 64).convert("RGB")
+    for i in range(count):
+        size = sizes[i % len(sizes)]
+        image_format = formats[(i // len(sizes)) % len(formats)]
+        color = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.new("RGB", size, color)
+        # 一部にノイズを敷き詰めて圧縮しにくい領域を作る
+        for x in range(0, size[0] // 2, 256):
+            for y in range(0, size[1] // 2, 256):
+                image.paste(noise_tile, (x, y))
+        image.save(directory / f"bench_{i:05d}{EXTENSIONS[image_format]}", format=image_format)
+    return directory
+
+
+def peak_rss_bytes():
+    """このプロセスの最大常駐メモリ（取得できない環境ではNone）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # LinuxはKB単位、macOSはバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def copy_corpus(source, destination):
+    """指定された画像フォルダの画像だけを作業用フォルダにコピーする（元のフォルダには書き込まない）"""
+    destination = Path(destination)
+    destination.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for path in sorted(Path(source).iterdir()):
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS:
+            shutil.copy2(path, destination / path.name)
+            count += 1
+    return count
+
+
+def remove_created(directory, existing):
+    """existingに含まれない（後から作成された）ファイルとフォルダを削除する"""
+    created = set(Path(directory).rglob("*")) - existing
+    for path in sorted(created, key=lambda p: len(p.parts), reverse=True):
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+
+def run_scenario(name, corpus, endpoints):
+    """1つのシナリオを実行して計測結果を返す（メモリ計測を分けるため子プロセスで呼ばれる）"""
+    import logging
+    import main
+
+    logging.getLogger().setLevel(logging.WARNING)
+    settings = dict(SCENARIOS[name]["analyzer"], endpoints=endpoints, model="benchmark")
+    analyzer = main.ImageAnalyzer(**settings)
+    existing = set(Path(corpus).rglob("*"))
+    cpu_start = os.times()
+    wall_start = time.perf_counter()
+    try:
+        processed, errors = analyzer.process_directory(corpus)
+    finally:
+        analyzer.close()
+        wall_sec = time.perf_counter() - wall_start
+        cpu_end = os.times()
+        # 次のシナリオを同じ条件で実行するため、このシナリオが作成したファイルだけを消す
+        remove_created(corpus, existing)
+
+    performance = analyzer.last_summary["performance"]
+    total = performance["stages"].get("total", {})
+    return {
+        "scenario": name,
+        "processed": processed,
+        "errors": errors,
+        "wall_sec": wall_sec,
+        "images_per_sec": processed / wall_sec if wall_sec > 0 else 0.0,
+        "latency_p50": total.get("p50"),
+        "latency_p95": total.get("p95"),
+        "latency_p99": total.get("p99"),
+        "payload_bytes_mean": performance["payload_bytes_mean"],
+        "cpu_sec": (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+                   + (cpu_end.children_user - cpu_start.children_user)
+                   + (cpu_end.children_system - cpu_start.children_system),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def check_cleaner(path, repeat=200):
+    """ResponseCleanerの出力が期待出力（従来のclean_responseの出力）と一致するか確認し、処理時間を計測する"""
+    from main import RESPONSE_CLEANER
+
+    with open(path, "r", encoding="utf-8") as f:
+        cases = json.load(f)["cases"]
+    mismatches = []
+    for case in cases:
+        actual = RESPONSE_CLEANER.clean(case["input"])
+        if actual != case["expected"]:
+            mismatches.append((case, actual))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for case in cases:
+            RESPONSE_CLEANER.clean(case["input"])
+    elapsed = time.perf_counter() - start
+    for case, actual in mismatches:
+        print(f"不一致: 入力 {case['input']!r}\n  期待 {case['expected']!r}\n  結果 {actual!r}")
+    print(f"クリーニング: {len(cases) - len(mismatches)}/{len(cases)}件一致 / "
+          f"1件あたり {elapsed / (repeat * len(cases)) * 1e6:.1f}µs")
+    return not mismatches
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def format_table(results, baseline=None):
+    baseline = {r["scenario"]: r for r in (baseline or [])}
+    header = f"{'scenario':<22}{'img/s':>9}{'p50':>8}{'p95':>8}{'p99':>8}{'cpu s':>8}{'rss MB':>9}{'err':>5}"
+    if baseline:
+        header += f"{'vs base':>10}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        rss = f"{r['peak_rss_bytes'] / 1048576:.0f}" if r["peak_rss_bytes"] else "-"
+        line = (f"{r['scenario']:<22}{r['images_per_sec']:>9.2f}"
+                f"{r['latency_p50'] or 0:>8.3f}{r['latency_p95'] or 0:>8.3f}{r['latency_p99'] or 0:>8.3f}"
+                f"{r['cpu_sec']:>8.2f}{rss:>9}{r['errors']:>5}")
+        base = baseline.get(r["scenario"])
+        if base and base["images_per_sec"]:
+            line += f"{r['images_per_sec'] / base['images_per_sec']:>9.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="疑似Ollamaサーバーを使ったImageAnalyzerのベンチマーク")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="実行するシナリオ（複数指定可。既定: 全シナリオ）")
+    parser.add_argument("--images", type=int, default=40, help="合成画像の枚数")
+    parser.add_argument("--corpus", help="使用する画像フォルダ（未指定時は一時フォルダに合成画像を作成）")
+    parser.add_argument("--latency", type=float, default=0.2, help="疑似サーバーの1リクエストあたりの生成時間（秒）")
+    parser.add_argument("--jitter", type=float, default=0.05, help="生成時間のばらつき（秒）")
+    parser.add_argument("--tokens", type=int, default=60, help="1応答あたりのトークン（単語）数")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="疑似サーバーが500を返す割合")
+    parser.add_argument("--parallel", type=int, default=4, help="疑似サーバー1台あたりの同時生成数")
+    parser.add_argument("--output", help="結果をJSONで保存するファイル")
+    parser.add_argument("--compare", help="比較対象として読み込む以前の結果（JSON）")
+    parser.add_argument("--check-cleaner", nargs="?", const=str(GOLDEN_PATH), metavar="JSON",
+                        help="応答のクリーニング結果を期待出力と照合して終了する（既定: clean_response_golden.json）")
+    # 子プロセスとして1シナリオだけ実行するための内部オプション
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--endpoint", action="append", default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.check_cleaner:
+        return 0 if check_cleaner(args.check_cleaner) else 1
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, args.corpus, args.endpoint)))
+        return 0
+
+    # 出力は作業用の一時フォルダに書き、--corpusで指定されたフォルダには書き込まない
+    temp_dir = tempfile.mkdtemp(prefix="tagollama_bench_")
+    corpus = os.path.join(temp_dir, "images")
+    results = []
+    try:
+        if args.corpus:
+            count = copy_corpus(args.corpus, corpus)
+            print(f"画像を作業用フォルダにコピーしました: {count}枚", file=sys.stderr)
+        else:
+            print(f"合成画像を作成しています: {args.images}枚", file=sys.stderr)
+            generate_corpus(corpus, args.images)
+
+        for name in args.scenario or list(SCENARIOS):
+            scenario = SCENARIOS[name]
+            server_options = dict(latency=args.latency, jitter=args.jitter, tokens=args.tokens,
+                                  failure_rate=args.failure_rate, parallel=args.parallel)
+            server_options.update(scenario.get("server", {}))
+            servers = [FakeOllamaServer(**server_options, seed=i).start()
+                       for i in range(scenario.get("endpoints", 1))]
+            try:
+                command = [sys.executable, os.path.abspath(__file__), "--run-scenario", name, "--corpus", corpus]
+                for server in servers:
+                    command += ["--endpoint", server.url]
+                print(f"実行中: {name}", file=sys.stderr)
+                completed = subprocess.run(command, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stderr, file=sys.stderr)
+                    continue
+                results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+            finally:
+                for server in servers:
+                    server.stop()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print(format_table(results, baseline))
+
+    if args.output:
+        report = {
+            "revision": git_revision(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "settings": {k: getattr(args, k) for k in ("images", "latency", "jitter", "tokens", "failure_rate", "parallel")},
+            "results": results,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,40 @@
 import os
 import base64
-import requests
+import hashlib
+import json
+import fnmatch
+import itertools
+import queue
+import collections
+import math
+import mmap
+import random
+import sqlite3
 import subprocess
+import sys
 import time
+import argparse
+import signal
+import socket
+import uuid
 from pathlib import Path
-from PIL import Image
 import io
 import logging
-import tkinter as tk
-from tkinter import filedialog, ttk, scrolledtext
-from threading import Thread
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import re
 
+# requests・PIL・tkinterは起動を速くするため、実際に使う時点でインポートする
+# （CLIではtkinterを一切読み込まない）
+tk = filedialog = ttk = scrolledtext = None
+
+
+def load_tkinter():
+    """GUI用にtkinterを遅延インポートする"""
+    global tk, filedialog, ttk, scrolledtext
+    import tkinter as tk
+    from tkinter import filedialog, ttk, scrolledtext
+
 # ロギングの設定
 logging.basicConfig(
     level=logging.INFO,
@@ -19,64 +42,1309 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class ImageAnalyzer:
-    def __init__(self, model="gemma3:27b", use_japanese=False, detail_level="standard", custom_prompt=None, clean_custom_response=True):
-        self.model = model
-        self.use_japanese = use_japanese
-        self.detail_level = detail_level
-        self.custom_prompt = custom_prompt
-        self.clean_custom_response = clean_custom_response
-        self.api_url = "http://localhost:11434/api/generate"
-        self.supported_formats = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+# GUIで結果キャッシュを有効にした場合の保存先
+DEFAULT_CACHE_PATH = Path.home() / ".tagollama" / "cache.sqlite3"
 
-    def start_ollama(self):
-        """Ollamaを起動する"""
-        try:
-            # Ollamaの状態をチェック
+# ストリーミング時に詳細度ごとに打ち切る文数（プロンプトで指示した文数の上限）
+DETAIL_SENTENCE_LIMITS = {"brief": 1, "standard": 3, "detailed": 5}
+
+# 品質パラメータを受け付ける出力形式
+LOSSY_FORMATS = {'JPEG', 'WEBP'}
+# 縮小も形式変換も不要な場合に、デコードせず元のファイルをそのまま送る形式
+PASSTHROUGH_FORMATS = {'JPEG', 'PNG'}
+
+
+class ImagePayload:
+    """送信する画像データ（元ファイルをそのまま送る場合はパスだけを持ち、送信時に読み込む）
+
+    Base64は送信時にチャンクごとに作るため、画像全体のBase64文字列はメモリ上に作らない。
+    """
+
+    # これ以上のファイルはmmapで読む
+    MMAP_THRESHOLD = 4 * 1024 * 1024
+    # 3の倍数にして、途中のチャンクのBase64にパディングが入らないようにする
+    CHUNK_SIZE = 3 * 256 * 1024
+
+    def __init__(self, path=None, data=None):
+        self.path = path
+        self.data = data
+        self.size = len(data) if data is not None else os.path.getsize(path)
+
+    def __len__(self):
+        """Base64にした場合の長さ"""
+        return (self.size + 2) // 3 * 4
+
+    def iter_base64(self):
+        """Base64をチャンクごとに生成する"""
+        if self.data is not None:
+            yield from self._encode_chunks(memoryview(self.data))
+            return
+        with open(self.path, 'rb') as f:
+            if self.size < self.MMAP_THRESHOLD:
+                yield from self._encode_chunks(memoryview(f.read(self.size)))
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # スライスはチャンク分だけのコピーなので、ファイル全体を読み込まない
+                for offset in range(0, self.size, self.CHUNK_SIZE):
+                    yield base64.b64encode(mapped[offset:min(offset + self.CHUNK_SIZE, self.size)])
+
+    def _encode_chunks(self, view):
+        for offset in range(0, len(view), self.CHUNK_SIZE):
+            yield base64.b64encode(view[offset:offset + self.CHUNK_SIZE])
+
+    def to_base64(self):
+        return b"".join(self.iter_base64()).decode('ascii')
+
+
+class JsonBody:
+    """ImagePayloadを含むリクエストをJSONとして逐次書き出すリクエストボディ
+
+    長さを先に計算できるため、チャンク転送ではなくContent-Length付きで送信できる。
+    """
+
+    # 画像の位置の目印（json.dumpsで "\u0000image0\u0000" のようにエスケープされる）
+    PLACEHOLDER = re.compile(r'"\\u0000image(\d+)\\u0000"')
+
+    def __init__(self, payload):
+        images = []
+
+        def replace_image(obj):
+            if isinstance(obj, ImagePayload):
+                images.append(obj)
+                return f"\x00image{len(images) - 1}\x00"
+            raise TypeError(f"JSONに変換できない値です: {type(obj).__name__}")
+
+        text = json.dumps(payload, default=replace_image)
+        # 画像の位置で分割し、[JSON, 画像番号, JSON, 画像番号, ..., JSON] の並びにする
+        parts = self.PLACEHOLDER.split(text)
+        self.texts = [part.encode('utf-8') for part in parts[0::2]]
+        self.images = [images[int(index)] for index in parts[1::2]]
+
+    def __len__(self):
+        return sum(len(text) for text in self.texts) + sum(len(image) + 2 for image in self.images)
+
+    def __iter__(self):
+        for text, image in zip(self.texts, self.images):
+            yield text
+            yield b'"'
+            yield from image.iter_base64()
+            yield b'"'
+        yield self.texts[-1]
+
+
+def compute_resize_scale(size, max_edge=None, max_pixels=None):
+    """最大辺・最大画素数の制限を満たす縮小率を計算する（縮小不要なら1.0）"""
+    width, height = size
+    scale = 1.0
+    if max_edge:
+        scale = min(scale, max_edge / max(width, height))
+    if max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+    return scale
+
+
+def encode_image_file(image_path, max_edge=None, max_pixels=None, target_format=None, quality=85):
+    """画像を必要に応じて縮小・形式変換し、送信するImagePayloadを返す"""
+    from PIL import Image
+
+    # Image.openはヘッダーだけを読むため、変換が不要ならデコードせずに元のファイルを送る
+    with Image.open(image_path) as source:
+        output_format = (target_format or source.format).upper()
+        scale = compute_resize_scale(source.size, max_edge, max_pixels)
+        if scale >= 1.0 and target_format is None and source.format in PASSTHROUGH_FORMATS:
+            return ImagePayload(path=str(image_path))
+
+        img = source
+        if scale < 1.0:
+            target_size = (max(1, int(source.width * scale)), max(1, int(source.height * scale)))
+            # JPEGはdraftモードでデコード時に1/2〜1/8へ縮小し、デコード自体を軽くする
+            if source.format == 'JPEG':
+                source.draft('RGB', target_size)
+            if img.mode in ('1', 'P'):
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            img = img.resize(target_size, Image.LANCZOS)
+
+        save_options = {}
+        if output_format in LOSSY_FORMATS:
+            save_options['quality'] = quality
+        if output_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format=output_format, **save_options)
+        return ImagePayload(data=img_buffer.getvalue())
+
+
+def timed_call(func, *args, **kwargs):
+    """関数を実行し、(戻り値, 経過秒数) を返す（プロセスプールで計測する場合に使う）"""
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """ファイル内容のSHA-256ハッシュを計算する"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(image_path, hash_size=8):
+    """画像のdHash（隣り合う画素の明暗の差分）を hash_size*hash_size ビットの整数で返す
+
+    縮小・形式変換・軽い再圧縮ではほとんど変化しないため、ハミング距離で類似画像を判定できる。
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        # JPEGは縮小デコードで読み込み、全画素のデコードを避ける
+        img.draft('L', ((hash_size + 1) * 8, hash_size * 8))
+        small = img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    """2つのハッシュのハミング距離"""
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """ハミング距離で近いハッシュを探索するBK木"""
+
+    def __init__(self):
+        # ノードは [ハッシュ, 値, {距離: 子ノード}]
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value, value):
+        self.size += 1
+        node = [hash_value, value, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def find_nearest(self, hash_value, max_distance):
+        """max_distance以内で最も近い (距離, 値) を返す（無ければNone）"""
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node[1])
+                if distance == 0:
+                    break
+            # 三角不等式により、距離が distance±max_distance の枝だけを調べればよい
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+        return best
+
+
+class DuplicateIndex:
+    """1回の実行内で見つかった類似画像を代表画像にまとめ、代表画像の分析結果を共有する"""
+
+    class Entry:
+        def __init__(self, image_path, stop):
+            self.image_path = image_path
+            self.result = None
+            self._done = Event()
+            self._stop = stop
+
+        def resolve(self, result):
+            """代表画像の分析結果を設定する（失敗時はNone）"""
+            self.result = result
+            self._done.set()
+
+        def wait(self):
+            """代表画像の結果を待つ（停止要求があった場合は待たずにNoneを返す）"""
+            while not self._done.wait(0.2):
+                if self._stop.is_set():
+                    return None
+            return self.result
+
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def claim(self, image_path, hash_value):
+        """近い代表画像があれば (エントリ, 距離)、無ければ新しい代表として (エントリ, None) を返す"""
+        with self._lock:
+            nearest = self.tree.find_nearest(hash_value, self.max_distance)
+            if nearest is not None:
+                return nearest[1], nearest[0]
+            entry = self.Entry(image_path, self._stop)
+            self.tree.add(hash_value, entry)
+            return entry, None
+
+    def stop(self):
+        """代表画像の結果を待っている類似画像の待機を解く"""
+        self._stop.set()
+
+
+class ResponseCleaner:
+    """clean_responseの正規表現を一度だけコンパイルし、まとめて適用するクリーニングエンジン
+
+    パターンは元の実装と同じく「先頭から順に1回ずつ適用し、毎回strip」という意味を保つ。
+    行頭(^)のパターンが連続する部分は1つの選択パターンにまとめ、どのパターンが一致したかを
+    グループ番号から求めて、その次のパターンから照合を続ける。
+    """
+
+    def __init__(self, patterns, bullet_pattern, label_pattern, meta_prefixes):
+        self.patterns = list(patterns)
+        self.bullet_pattern = bullet_pattern
+        self.label_pattern = label_pattern
+        self.meta_prefixes = tuple(meta_prefixes)
+        # コンパイルは起動を遅くしないよう最初のclean呼び出し時に行う
+        self.steps = None
+
+    def _compile(self):
+        steps = []
+        anchored = []
+        for pattern in self.patterns:
+            if pattern.startswith('^'):
+                anchored.append(pattern[1:])
+                continue
+            if anchored:
+                steps.append(self._compile_anchored(anchored))
+                anchored = []
+            steps.append(('sub', re.compile(pattern, re.IGNORECASE)))
+        if anchored:
+            steps.append(self._compile_anchored(anchored))
+        self.bullet_regex = re.compile(self.bullet_pattern)
+        self.label_regex = re.compile(self.label_pattern)
+        # 複数スレッドから同時に呼ばれても、完成したリストを最後に代入するので安全
+        self.steps = steps
+
+    @staticmethod
+    def _compile_anchored(patterns):
+        # alternations[k] はk番目以降のパターンをまとめた選択パターン（グループiがk+i-1番目に対応）
+        alternations = [
+            re.compile('|'.join(f'({pattern})' for pattern in patterns[k:]), re.IGNORECASE)
+            for k in range(len(patterns))
+        ]
+        return ('anchored', alternations)
+
+    def clean(self, response):
+        if self.steps is None:
+            self._compile()
+        text = response.strip()
+
+        # 1〜2. 前置き表現や接続表現の削除（元の適用順を保持）
+        for kind, compiled in self.steps:
+            if kind == 'sub':
+                text = compiled.sub("", text).strip()
+                continue
+            k = 0
+            while k < len(compiled):
+                match = compiled[k].match(text)
+                if match is None:
+                    break
+                text = text[match.end():].strip()
+                k += match.lastindex
+
+        # 3. 改行や箇条書き記号をカンマに変換し、セグメントへの分割は1回だけ行う
+        text = self.bullet_regex.sub(', ', text)
+        segments = []
+        for segment in text.split(','):
+            segment = segment.strip()
+            if not segment or segment.startswith('、'):
+                continue
+            # 4. カテゴリラベル（例 "General:" や "Style/Art:"）の削除
+            if self.label_regex.match(segment):
+                continue
+            # 5. タグ生成に関する補足文などメタ情報の削除
+            if segment.lower().startswith(self.meta_prefixes):
+                continue
+            segments.append(segment)
+        return ', '.join(segments)
+
+
+RESPONSE_CLEANER = ResponseCleaner(
+    patterns=[
+        # 1. 初期クリーニング：不要な前置き表現の削除
+        r"^Here’s a description of the image in 2, ",
+        r"^説明[:：]\s*",
+        r"^Here's .*?:",
+        r"^This image shows",
+        r"^The image shows",
+        r"^In this image,",
+        r"^The image depicts",
+        r"^This image depicts",
+        r"^The photo shows",
+        r"^The picture shows",
+        r"^I will describe",
+        r"^I'll describe",
+        r"^Let me describe",
+        r"^I can see",
+        r"^画像には",
+        r"^この画像には",
+        r"^この画像は",
+        r"^写真には",
+        r"^画像は",
+        r"^この画像を.*?で説明します。?\n?",
+        r"^以下.*?で説明します。?\n?",
+        r"^、",
+        # 2. 追加のクリーニング：一般的な接続表現や余計な表現の削除
+        r"^また、?",
+        r"^そして、?",
+        r"^なお、?",
+        r"^さらに、?",
+        r"^加えて、?",
+        r"^特に、?",
+        r"^具体的には、?",
+        r"^Additionally,\s*",
+        r"^Moreover,\s*",
+        r"^Furthermore,\s*",
+        r"^Also,\s*",
+        r"^And\s*",
+        r"^Specifically,\s*",
+        r"^There\s+(?:is|are)\s+",
+        r"^We\s+can\s+see\s+",
+        r"^You\s+can\s+see\s+",
+        r"^It\s+appears\s+",
+        r"これは",
+        r"それは",
+        r"以下は",
+        r"次のような",
+        r"(?:以下の)?(?:画像に適用できる)?(?:Danbooru|だんぼーる|ダンボール|ダンボーる)?タグ(?:です|となります)。?\n?",
+        r"タグ(?:一覧|リスト)：\n?",
+        r"^[*＊・]",  # 行頭の箇条書き記号
+        r"^、",      # 行頭の読点
+        r"主な(?:特徴|要素)(?:：|は)(?:以下の)?(?:通り|とおり)(?:です)?。?\n?",
+    ],
+    # 改行や箇条書き記号
+    bullet_pattern=r'[・\-•*＊\n] ?',
+    # 英数字、"/", "-"、スペースのみで構成され、末尾がコロンのセグメントはラベルと判断
+    label_pattern=r'^[A-Za-z0-9/\- ]+:$',
+    meta_prefixes=[
+        "i've prioritized tags",
+        "possible additional tags",
+        "optional additional tags",
+        "additional suggestions",
+        "generated tags",
+        "based on danbooru tagging conventions",
+        "i have included tags that describe",
+        "i selected tags to best capture",
+        "i generated these tags using",
+        "generated by ai",
+        "metadata",
+    ]
+)
+
+
+class GenerationLimit:
+    """ストリーミング生成を打ち切る条件（文数・タグ数）を逐次判定する"""
+
+    # 英語は後ろに空白が続く場合のみ文末とみなす（"3.5" などの誤判定を避ける）
+    SENTENCE_END = re.compile(r'[.!?](?=\s)|[。！？]')
+    TAG_SEPARATOR = re.compile(r'[,、\n]')
+
+    def __init__(self, max_sentences=None, max_tags=None):
+        self.max_sentences = max_sentences
+        self.max_tags = max_tags
+        self._sentences = 0
+        self._sentence_pos = 0
+        self._tags = 0
+        self._tag_pos = 0
+
+    def __bool__(self):
+        return bool(self.max_sentences or self.max_tags)
+
+    def feed(self, text):
+        """受信済みのテキスト全体を渡し、打ち切る位置を返す（条件未達ならNone）
+
+        前回までに判定した位置から先だけを走査するため、長い生成でも判定コストは増えない。
+        """
+        if self.max_sentences:
+            for match in self.SENTENCE_END.finditer(text, self._sentence_pos):
+                self._sentences += 1
+                self._sentence_pos = match.end()
+                if self._sentences >= self.max_sentences:
+                    return match.end()
+        if self.max_tags:
+            for match in self.TAG_SEPARATOR.finditer(text, self._tag_pos):
+                if text[self._tag_pos:match.start()].strip():
+                    self._tags += 1
+                self._tag_pos = match.end()
+                if self._tags >= self.max_tags:
+                    return match.start()
+        return None
+
+
+class NoEndpointAvailable(Exception):
+    """リクエストを送れる正常なOllamaサーバーが残っていないことを表す"""
+
+
+class Endpoint:
+    """負荷分散先のOllamaサーバー1台分の状態"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.in_flight = 0
+        self.latency = None  # 直近のリクエスト時間の指数移動平均（秒）
+        self.healthy = True
+        self.completed = 0
+        self.failures = 0
+
+
+class EndpointBalancer:
+    """実行中のリクエスト数と応答時間を見て、最も空いている正常なサーバーへ振り分ける
+
+    接続に失敗したサーバーはローテーションから外し、バックグラウンドで定期的に
+    /api/tags を確認して応答が戻れば復帰させる。
+    """
+
+    ERROR_PENALTY = 1.0  # エラーを返したサーバーに加算する最小の見込み時間（秒）
+    MAX_PENALTY = 300.0
+
+    def __init__(self, base_urls, probe, probe_interval=15.0, smoothing=0.3):
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.smoothing = smoothing
+        self._lock = Lock()
+        self._stop = Event()
+        self._probe_thread = None
+
+    def start(self):
+        """停止中のサーバーを定期的に確認するスレッドを開始する"""
+        if self._probe_thread is None:
+            self._stop.clear()
+            self._probe_thread = Thread(target=self._probe_loop, daemon=True)
+            self._probe_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._probe_thread is not None:
+            self._probe_thread.join()
+            self._probe_thread = None
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            for endpoint in self.endpoints:
+                if not endpoint.healthy and self.probe(endpoint.base_url):
+                    logger.info(f"Ollamaサーバーが復帰しました: {endpoint.base_url}")
+                    with self._lock:
+                        endpoint.healthy = True
+
+    def probe_all(self):
+        """全サーバーの応答を確認し、正常なサーバー数を返す"""
+        for endpoint in self.endpoints:
+            healthy = self.probe(endpoint.base_url)
+            if not healthy:
+                logger.warning(f"Ollamaサーバーに接続できません: {endpoint.base_url}")
+            with self._lock:
+                endpoint.healthy = healthy
+        return sum(endpoint.healthy for endpoint in self.endpoints)
+
+    def acquire(self, exclude=(), prefer=None):
+        """リクエストを送るサーバーを選び、実行中として数える（preferのURLが使えればそれを選ぶ）"""
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.healthy and e not in exclude]
+            if not candidates:
+                raise NoEndpointAvailable("利用可能なOllamaサーバーがありません")
+            for endpoint in candidates:
+                if endpoint.base_url == prefer:
+                    endpoint.in_flight += 1
+                    return endpoint
+            # 「待ち行列に並んだ場合に完了するまでの見込み時間」が最小のサーバーを選ぶ
+            # （応答時間が未計測のサーバーは計測済みのサーバーの平均で見積もる）
+            measured = [e.latency for e in candidates if e.latency is not None]
+            default_latency = sum(measured) / len(measured) if measured else 0
+
+            def expected_time(e):
+                latency = e.latency if e.latency is not None else default_latency
+                return (e.in_flight + 1) * latency, e.in_flight
+
+            endpoint = min(candidates, key=expected_time)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def release(self, endpoint, elapsed=None, failed=False, errored=False):
+        """リクエストの完了を記録する
+
+        failed=Trueは接続できなかった場合で、ローテーションから外す。
+        errored=Trueはサーバーがエラーを返した場合で、応答時間を悪化させて選ばれにくくする。
+        """
+        with self._lock:
+            endpoint.in_flight -= 1
+            if failed:
+                endpoint.failures += 1
+                endpoint.healthy = False
+                return
+            if errored:
+                # 失敗のたびに見込み時間を倍にする（成功すれば移動平均で元に戻っていく）
+                endpoint.failures += 1
+                penalty = max(endpoint.latency or 0, elapsed or 0, self.ERROR_PENALTY)
+                endpoint.latency = min(penalty * 2, self.MAX_PENALTY)
+                return
+            if elapsed is not None:
+                endpoint.completed += 1
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += self.smoothing * (elapsed - endpoint.latency)
+
+    def summary(self):
+        """サーバーごとの処理件数と失敗回数"""
+        with self._lock:
+            return {e.base_url: {'completed': e.completed, 'failures': e.failures} for e in self.endpoints}
+
+
+class RequestCancelled(Exception):
+    """ヘッジで先に応答が返ったため、もう一方のリクエストを打ち切ったことを表す"""
+
+
+class CancelHandle:
+    """ヘッジで遅れた方のリクエストを打ち切るための合図
+
+    受信中のレスポンスを登録しておき、打ち切る際に次のチャンクを待たずに接続を直接閉じる。
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._response = None
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def set(self):
+        with self._lock:
+            self._event.set()
+            response, self._response = self._response, None
+        if response is not None:
+            self._abort(response)
+
+    def attach(self, response):
+        """受信中のレスポンスを登録する（既に打ち切られていればその場で閉じる）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._response = response
+                return
+        self._abort(response)
+
+    def detach(self):
+        with self._lock:
+            self._response = None
+
+    @staticmethod
+    def _abort(response):
+        # close()だけでは別スレッドで受信待ちのソケットが起きないため、先にshutdownする
+        connection = getattr(response.raw, '_connection', None)
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
             try:
-                response = requests.get("http://localhost:11434/api/tags")
-                if response.status_code == 200:
-                    logger.info("Ollamaは既に起動しています")
-                    return True
-            except requests.exceptions.ConnectionError:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
+        response.close()
 
-            logger.info("Ollamaを起動しています...")
-            # PowerShellでバックグラウンド実行
-            subprocess.Popen(['powershell', 'Start-Process', 'ollama', 'serve'], 
-                           creationflags=subprocess.CREATE_NO_WINDOW)
 
-            # Ollamaが起動するまで待機
-            max_attempts = 30
-            for _ in range(max_attempts):
-                try:
-                    response = requests.get("http://localhost:11434/api/tags")
-                    if response.status_code == 200:
-                        logger.info("Ollama起動完了")
-                        return True
-                except requests.exceptions.ConnectionError:
-                    time.sleep(1)
-                    continue
+class LatencyWindow:
+    """直近のリクエスト時間を保持し、ヘッジを送るまでの待ち時間（パーセンタイル）を求める"""
 
-            logger.error("Ollamaの起動がタイムアウトしました")
+    def __init__(self, size=200, min_samples=10):
+        self.min_samples = min_samples
+        self._values = collections.deque(maxlen=size)
+        self._lock = Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, quantile):
+        """サンプルが足りない間はNone"""
+        with self._lock:
+            if len(self._values) < self.min_samples:
+                return None
+            values = sorted(self._values)
+        return PerfRecorder.percentile(values, quantile)
+
+
+class PerfRecorder:
+    """画像ごとの段階別の処理時間を記録し、実行全体の性能レポートを作る"""
+
+    # (記録のキー, レポートでの段階名)
+    STAGES = [
+        ('dedup_sec', 'dedup'),
+        ('encode_sec', 'encode'),
+        ('encode_wait_sec', 'encode_wait'),
+        ('request_sec', 'request'),
+        ('ttft', 'ttft'),
+        ('server_total_sec', 'server_total'),
+        ('load_sec', 'server_load'),
+        ('server_prompt_eval_sec', 'server_prompt_eval'),
+        ('server_eval_sec', 'server_eval'),
+        ('clean_sec', 'clean'),
+        ('write_sec', 'write'),
+        ('total_sec', 'total'),
+    ]
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self):
+        self.records = []
+        self._lock = Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    @staticmethod
+    def percentile(sorted_values, quantile):
+        """最近傍順位法でパーセンタイルを求める"""
+        index = max(0, math.ceil(quantile * len(sorted_values)) - 1)
+        return sorted_values[index]
+
+    def summary(self, wall_sec):
+        """段階ごとのp50/p95/p99、スループット、送信サイズを集計する"""
+        with self._lock:
+            records = list(self.records)
+        stages = {}
+        for key, name in self.STAGES:
+            values = sorted(r[key] for r in records if r.get(key) is not None)
+            if not values:
+                continue
+            stage = {'count': len(values), 'mean': sum(values) / len(values), 'max': values[-1]}
+            for quantile in self.QUANTILES:
+                stage[f'p{int(quantile * 100)}'] = self.percentile(values, quantile)
+            stages[name] = stage
+        payload_sizes = [r['payload_bytes'] for r in records if r.get('payload_bytes')]
+        tokens_per_sec = [r['tokens_per_sec'] for r in records if r.get('tokens_per_sec')]
+        return {
+            'images': len(records),
+            'cached': sum(1 for r in records if r.get('cached')),
+            'wall_sec': wall_sec,
+            'images_per_sec': len(records) / wall_sec if wall_sec > 0 else 0.0,
+            'payload_bytes_total': sum(payload_sizes),
+            'payload_bytes_mean': sum(payload_sizes) / len(payload_sizes) if payload_sizes else 0,
+            'tokens_per_sec_mean': sum(tokens_per_sec) / len(tokens_per_sec) if tokens_per_sec else 0,
+            'stages': stages
+        }
+
+    def export(self, path, summary, format="json"):
+        """レポートをJSONまたはPrometheusのtextfile形式で書き出す"""
+        path = Path(path)
+        if format == "prometheus":
+            content = self.prometheus_text(summary)
+        else:
+            content = json.dumps({'summary': summary, 'records': self.records}, ensure_ascii=False, indent=2)
+        # node_exporterなどが書きかけのファイルを読まないよう、一時ファイルから置き換える
+        temp_path = path.with_name(path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def prometheus_text(summary):
+        lines = [
+            "# HELP tagollama_last_run_images Images completed in the last run.",
+            "# TYPE tagollama_last_run_images gauge",
+            f"tagollama_last_run_images {summary['images']}",
+            "# HELP tagollama_last_run_images_cached Images answered from the result cache in the last run.",
+            "# TYPE tagollama_last_run_images_cached gauge",
+            f"tagollama_last_run_images_cached {summary['cached']}",
+            "# HELP tagollama_images_per_second Throughput of the last run.",
+            "# TYPE tagollama_images_per_second gauge",
+            f"tagollama_images_per_second {summary['images_per_sec']:.6f}",
+            "# HELP tagollama_last_run_payload_bytes Base64 image bytes sent in the last run.",
+            "# TYPE tagollama_last_run_payload_bytes gauge",
+            f"tagollama_last_run_payload_bytes {summary['payload_bytes_total']}",
+            "# HELP tagollama_tokens_per_second Mean generation speed reported by the server.",
+            "# TYPE tagollama_tokens_per_second gauge",
+            f"tagollama_tokens_per_second {summary['tokens_per_sec_mean']:.6f}",
+            "# HELP tagollama_stage_seconds Per-image latency of each processing stage.",
+            "# TYPE tagollama_stage_seconds summary",
+        ]
+        for name, stage in summary['stages'].items():
+            for quantile in PerfRecorder.QUANTILES:
+                value = stage[f'p{int(quantile * 100)}']
+                lines.append(f'tagollama_stage_seconds{{stage="{name}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'tagollama_stage_seconds_sum{{stage="{name}"}} {stage["mean"] * stage["count"]:.6f}')
+            lines.append(f'tagollama_stage_seconds_count{{stage="{name}"}} {stage["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+class ResultCache:
+    """画像内容と生成設定をキーに分析結果を保存するSQLiteキャッシュ"""
+
+    def __init__(self, cache_path, max_entries=100000, max_age_days=None):
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # ワーカースレッドから共有するため、ロックで排他しつつ1つの接続を使う
+        self._conn = sqlite3.connect(str(self.cache_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, "
+            "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    @staticmethod
+    def make_key(*values):
+        """画像ハッシュや生成設定からキーを作る"""
+        digest = hashlib.sha256()
+        for value in values:
+            digest.update(b'\0')
+            digest.update(repr(value).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """キャッシュされた結果を返す（無い場合はNone）"""
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, result):
+        """分析結果をキャッシュに保存する"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, result, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, result, now, now)
+            )
+            self._conn.commit()
+
+    def evict(self):
+        """古いエントリや上限を超えたエントリを削除する"""
+        with self._lock:
+            if self.max_age_days:
+                cutoff = time.time() - self.max_age_days * 86400
+                self._conn.execute("DELETE FROM results WHERE created_at < ?", (cutoff,))
+            if self.max_entries:
+                # 最後に使われた日時が古いものから削除
+                self._conn.execute(
+                    "DELETE FROM results WHERE key NOT IN "
+                    "(SELECT key FROM results ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+
+class RunManifest:
+    """完了した画像と生成設定を追記していく再開用マニフェスト（JSON Lines形式）"""
+
+    FILE_NAME = ".tagollama_manifest.jsonl"
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.manifest_path = self.directory / self.FILE_NAME
+        self.entries = {}
+        line_count = 0
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line_count += 1
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 中断時に書きかけになった行は無視する
+                        continue
+                    self.entries[entry['image']] = entry
+        # 同じ画像の記録が溜まっている場合は最新の記録だけに圧縮する
+        if line_count > len(self.entries) * 2:
+            self._rewrite()
+        self._file = open(self.manifest_path, 'a', encoding='utf-8')
+        # 出力先の書き込みを確定したワーカースレッドから記録されるため排他する
+        self._lock = Lock()
+
+    def _key(self, image_path):
+        return Path(image_path).relative_to(self.directory).as_posix()
+
+    def _rewrite(self):
+        temp_path = self.manifest_path.with_name(self.manifest_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.manifest_path)
+
+    def is_complete(self, image_path, signature, output_paths=()):
+        """同じ設定で処理済みで、出力がすべて画像より新しい場合はTrue
+
+        output_pathsが空の場合（JSONL/SQLiteへの出力）は、書き込み確定後に記録される
+        マニフェストの記録だけで判定する。
+        """
+        entry = self.entries.get(self._key(image_path))
+        if entry is None or entry.get('settings') != signature:
             return False
-        except Exception as e:
-            logger.error(f"Ollamaの起動中にエラーが発生しました: {str(e)}")
+        try:
+            image_stat = os.stat(image_path)
+            output_stats = [os.stat(output_path) for output_path in output_paths]
+        except OSError:
             return False
+        if entry.get('mtime') != image_stat.st_mtime or entry.get('size') != image_stat.st_size:
+            return False
+        return all(output_stat.st_mtime >= image_stat.st_mtime for output_stat in output_stats)
 
-    def encode_image(self, image_path):
-        """画像をBase64エンコードする"""
+    def record(self, image_paths, signature):
+        """画像の処理完了を記録する（中断に備えて即座に書き出す）"""
+        lines = []
+        for image_path in image_paths:
+            image_stat = os.stat(image_path)
+            entry = {
+                'image': self._key(image_path),
+                'settings': signature,
+                'mtime': image_stat.st_mtime,
+                'size': image_stat.st_size
+            }
+            lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+            with self._lock:
+                self.entries[entry['image']] = entry
+        with self._lock:
+            self._file.write("".join(lines))
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TextFileSink:
+    """画像と同じ場所に同名の .txt として結果を保存する出力先（従来の形式）"""
+
+    name = "txt"
+
+    def __init__(self, on_commit=None):
+        self.on_commit = on_commit
+
+    def output_path(self, image_path, profile=None):
+        suffix = profile.suffix if profile else ""
+        return Path(image_path).with_suffix(suffix + '.txt')
+
+    def output_paths(self, image_path, profiles):
+        return [self.output_path(image_path, profile) for profile in profiles]
+
+    def location(self, image_path, profiles=(None,)):
+        return ", ".join(str(path) for path in self.output_paths(image_path, profiles))
+
+    def write(self, image_path, outputs, metadata):
+        """outputsは (プロンプト設定, 結果) のリスト"""
+        for profile, result in outputs:
+            text_path = self.output_path(image_path, profile)
+            # 書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える
+            temp_path = text_path.with_name(text_path.name + ".tmp")
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(result)
+            os.replace(temp_path, text_path)
+        if self.on_commit:
+            self.on_commit([image_path])
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BufferedSink:
+    """結果をまとめて1つのファイルに書き込む出力先の共通処理（件数または時間ごとに確定する）"""
+
+    def __init__(self, output_path, on_commit=None, batch_size=100, flush_interval=5.0):
+        self.path = Path(output_path)
+        self.on_commit = on_commit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = Lock()
+
+    def output_paths(self, image_path, profiles):
+        # 画像ごとの出力ファイルは無い
+        return []
+
+    def location(self, image_path, profiles=(None,)):
+        return f"{self.path} ({Path(image_path).name})"
+
+    def write(self, image_path, outputs, metadata):
+        """outputsは (プロンプト設定, 結果) のリスト"""
+        with self._lock:
+            self._buffer.append((image_path, outputs, metadata))
+            if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                try:
+                    self._flush_locked()
+                except Exception as e:
+                    # 結果はバッファに残っているため、この画像の失敗とはせず次回の書き込みで再試行する
+                    logger.warning(f"出力先への書き込みに失敗しました。{len(self._buffer)}件を保持して再試行します: {str(e)}")
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        # 書き込みが確定するまでバッファから外さない（失敗しても次回まとめて書き直す）
+        self.commit(self._buffer)
+        batch, self._buffer = self._buffer, []
+        if self.on_commit:
+            self.on_commit([image_path for image_path, _, _ in batch])
+
+    def commit(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class JsonlSink(BufferedSink):
+    """全画像の結果を1つのJSON Linesファイルに追記する出力先"""
+
+    name = "jsonl"
+
+    def __init__(self, output_path, **kwargs):
+        super().__init__(output_path, **kwargs)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def commit(self, batch):
+        # バッチ全体を1回の書き込みにまとめ、fsyncで確定させてから完了を記録する
+        lines = [
+            json.dumps(dict(metadata, profile=profile.name, prompt=profile.prompt(), result=result),
+                       ensure_ascii=False) + "\n"
+            for _, outputs, metadata in batch
+            for profile, result in outputs
+        ]
+        position = self._file.seek(0, os.SEEK_END)
         try:
-            with Image.open(image_path) as img:
-                img_buffer = io.BytesIO()
-                img.save(img_buffer, format=img.format)
-                img_str = base64.b64encode(img_buffer.getvalue()).decode('utf-8')
-                return img_str
-        except Exception as e:
-            logger.error(f"画像のエンコード中にエラーが発生しました: {str(e)}")
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            # 書きかけの行を残さないよう、書き込み前の長さに戻してから失敗を伝える
+            self._file.truncate(position)
             raise
 
-    def get_prompt(self):
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._file.close()
+
+
+class SQLiteSink(BufferedSink):
+    """全画像の結果を1つのSQLiteデータベースに保存する出力先"""
+
+    name = "sqlite"
+
+    def __init__(self, output_path, **kwargs):
+        super().__init__(output_path, **kwargs)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "image TEXT NOT NULL, profile TEXT NOT NULL DEFAULT '', image_hash TEXT, model TEXT, prompt TEXT, "
+            "result TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (image, profile))"
+        )
+        self._conn.commit()
+
+    def commit(self, batch):
+        # バッチごとに1トランザクションでまとめて書き込む
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results (image, profile, image_hash, model, prompt, result, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(m['image'], profile.name or '', m.get('image_hash'), m.get('model'), profile.prompt(), result,
+                  m['created_at'])
+                 for _, outputs, m in batch
+                 for profile, result in outputs]
+            )
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._conn.close()
+
+
+# 出力先の種類と、output_path未指定時に処理フォルダ内に作るファイル名
+OUTPUT_SINKS = {
+    "txt": (TextFileSink, None),
+    "jsonl": (JsonlSink, "tagollama_results.jsonl"),
+    "sqlite": (SQLiteSink, "tagollama_results.sqlite3"),
+}
+
+
+class ShardLeases:
+    """共有フォルダ上のリースファイルで、複数のノードが同じ画像を重複して処理しないよう分担する
+
+    画像ごとに O_EXCL でリースファイルを作れた1台だけが処理し、処理中は更新時刻を定期的に
+    延長する。期限切れのリースは停止したワーカーのものとみなし、リネームで1台だけが引き継ぐ。
+    結果の書き込みが確定したらリースを .done に置き換える。
+    """
+
+    # 探索結果を一度に読み込む件数（巨大なフォルダでも全件をメモリに載せない）
+    WINDOW_SIZE = 1000
+
+    def __init__(self, directory, lease_directory, worker_id=None, ttl=120.0):
+        self.directory = Path(directory)
+        self.lease_directory = Path(lease_directory)
+        self.lease_directory.mkdir(parents=True, exist_ok=True)
+        self.worker_id = worker_id or self.default_worker_id()
+        self.ttl = ttl
+        self.claimed = 0
+        self.taken_over = 0
+        self._held = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self._heartbeat_thread = Thread(target=self._heartbeat_loop, daemon=True)
+        self._heartbeat_thread.start()
+
+    @staticmethod
+    def default_worker_id():
+        """ホスト名とプロセスIDからワーカーIDを作る"""
+        return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+    def _paths(self, image_path):
+        """画像の (リースファイル, 完了マーカー) のパス"""
+        relative_path = Path(image_path).relative_to(self.directory).as_posix()
+        name = hashlib.sha1(relative_path.encode('utf-8')).hexdigest()
+        return self.lease_directory / f"{name}.lease", self.lease_directory / f"{name}.done"
+
+    def _heartbeat_loop(self):
+        # 期限の1/3ごとに更新時刻を延ばし、処理中のリースが引き継がれないようにする
+        while not self._stop.wait(self.ttl / 3):
+            with self._lock:
+                leases = list(self._held.values())
+            for lease_path in leases:
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    pass
+
+    def try_claim(self, image_path):
+        """リースを取得し "claimed" を返す（処理済みなら "done"、他のワーカーが処理中なら "busy"）"""
+        lease_path, done_path = self._paths(image_path)
+        if done_path.exists():
+            return "done"
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            if not self._take_over_if_stale(lease_path):
+                return "busy"
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                return "busy"
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'worker': self.worker_id, 'image': str(image_path), 'claimed_at': time.time()}, f)
+        # 確認とリース作成の間に他のワーカーが完了させていた場合
+        if done_path.exists():
+            os.unlink(lease_path)
+            return "done"
+        with self._lock:
+            self._held[image_path] = lease_path
+            self.claimed += 1
+        return "claimed"
+
+    def _take_over_if_stale(self, lease_path):
+        """期限切れのリースを取り除く（取り除けたか、既に無い場合はTrue）"""
+        try:
+            if time.time() - os.stat(lease_path).st_mtime < self.ttl:
+                return False
+        except FileNotFoundError:
+            return True
+        # リネームは1台だけが成功するため、複数のワーカーが同時に引き継ぐことはない
+        stale_path = lease_path.with_name(f"{lease_path.name}.{self.worker_id}.stale")
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return True
+        try:
+            if time.time() - os.stat(stale_path).st_mtime < self.ttl:
+                # 確認とリネームの間に別のワーカーが取り直した新しいリースだった場合は元に戻す
+                try:
+                    os.link(stale_path, lease_path)
+                except FileExistsError:
+                    pass
+                return False
+            logger.info(f"期限切れのリースを引き継ぎます: {lease_path.name}")
+            self.taken_over += 1
+            return True
+        finally:
+            stale_path.unlink(missing_ok=True)
+
+    def iter_claims(self, image_paths):
+        """リースを取得できた画像を順に返す
+
+        探索結果はWINDOW_SIZE件ずつ読み、全ノードが同じ順に取り合わないよう各範囲の中で
+        開始位置をずらす。他のワーカーが処理中の画像は、探索し終えた後に完了するか
+        期限切れで引き継げるまで確認を続ける。
+        """
+        image_paths = iter(image_paths)
+        busy = []
+        while not self._stop.is_set():
+            window = list(itertools.islice(image_paths, self.WINDOW_SIZE))
+            if window:
+                offset = random.randrange(len(window))
+                window = window[offset:] + window[:offset]
+            elif busy:
+                self._stop.wait(min(self.ttl / 4, 1.0))
+                window, busy = busy, []
+            else:
+                return
+            for image_path in window:
+                if self._stop.is_set():
+                    return
+                state = self.try_claim(image_path)
+                if state == "claimed":
+                    yield image_path
+                elif state == "busy":
+                    busy.append(image_path)
+
+    def complete(self, image_paths):
+        """書き込みが確定した画像のリースを完了マーカーに置き換える"""
+        for image_path in image_paths:
+            with self._lock:
+                lease_path = self._held.pop(image_path, None)
+            if lease_path is None:
+                continue
+            done_path = self._paths(image_path)[1]
+            try:
+                os.replace(lease_path, done_path)
+            except FileNotFoundError:
+                # 引き継がれていた場合もリースは無くなっているため、完了マーカーだけを作る
+                done_path.touch()
+
+    def release(self, image_paths):
+        """処理できなかった画像のリースを手放し、他のワーカーが処理できるようにする"""
+        for image_path in image_paths:
+            with self._lock:
+                lease_path = self._held.pop(image_path, None)
+            if lease_path is not None:
+                lease_path.unlink(missing_ok=True)
+
+    def close(self):
+        """ハートビートを止め、完了しなかった画像のリースを手放す"""
+        self._stop.set()
+        self._heartbeat_thread.join()
+        with self._lock:
+            leases, self._held = list(self._held.values()), {}
+        for lease_path in leases:
+            lease_path.unlink(missing_ok=True)
+
+
+class FileDiscovery:
+    """ファイル探索を別スレッドで進め、見つかった順に処理側へ受け渡す"""
+
+    _DONE = object()
+    # next()でtimeout内に次のファイルが見つからなかったことを表す
+    PENDING = object()
+
+    def __init__(self, iterable, max_buffered=10000):
+        self.discovered = 0
+        self.finished = False
+        self._exhausted = False
+        # 探索が処理より大きく先行してもメモリを使い過ぎないよう、バッファに上限を設ける
+        self._queue = queue.Queue(maxsize=max_buffered)
+        self._stop = Event()
+        self._thread = Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                self.discovered += 1
+                if not self._put(item):
+                    return
+        except Exception as e:
+            logger.error(f"ファイルの探索中にエラーが発生しました: {str(e)}")
+        finally:
+            self.finished = True
+            self._put(self._DONE)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def next(self, timeout=None):
+        """次のファイルを返す（探索が終わっていればNone、timeout秒以内に見つからなければPENDING）"""
+        if self._exhausted:
+            return None
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return self.PENDING
+        if item is self._DONE:
+            self._exhausted = True
+            return None
+        return item
+
+    def __iter__(self):
+        while True:
+            item = self.next()
+            if item is None:
+                return
+            yield item
+
+    def stop(self):
+        """探索を打ち切る"""
+        self._stop.set()
+
+
+class PromptProfile:
+    """1つの出力に対応するプロンプト設定（言語・詳細度・カスタムプロンプト・クリーニング）
+
+    nameは出力ファイルの接尾辞になる（"en" なら image.en.txt、Noneなら従来どおり image.txt）。
+    """
+
+    def __init__(self, name=None, use_japanese=False, detail_level="standard", custom_prompt=None,
+                 clean_custom_response=True):
+        self.name = name
+        self.use_japanese = use_japanese
+        self.detail_level = detail_level
+        self.custom_prompt = custom_prompt
+        self.clean_custom_response = clean_custom_response
+
+    @property
+    def suffix(self):
+        return f".{self.name}" if self.name else ""
+
+    def prompt(self):
         """プロンプトを生成"""
         if self.custom_prompt:
             prompt = self.custom_prompt.strip()
@@ -102,144 +1370,628 @@ class ImageAnalyzer:
                 return "Describe this image in 2-3 sentences, focusing on key elements and actions. No introductory phrases."
             else:  # detailed
                 return "Describe this image in 4-5 sentences, including visual elements, actions, and atmosphere. No introductory phrases."
-    
-    
+
+
+class ImageAnalyzer:
+    # 画像はJsonBodyでBase64を逐次生成しながら送る
+    JSON_HEADERS = {'Content-Type': 'application/json'}
+
+    def __init__(self, model="gemma3:27b", use_japanese=False, detail_level="standard", custom_prompt=None, clean_custom_response=True, max_workers=1,
+                 max_image_edge=None, max_image_pixels=None, image_format=None, image_quality=85,
+                 prefetch_count=0, encode_workers=None,
+                 cache_path=None, cache_max_entries=100000, cache_max_age_days=None,
+                 incremental=False, recursive=False, include_patterns=None, exclude_patterns=None,
+                 stream=False, max_sentences=None, max_tags=None, num_predict=None,
+                 endpoints=None, keep_alive=None, num_ctx=None, temperature=None, warmup=True,
+                 metrics_path=None, metrics_format="json",
+                 output_sink="txt", output_path=None, sink_batch_size=100,
+                 dedup=False, dedup_distance=4, profiles=None,
+                 connect_timeout=10, read_timeout=300, max_retries=2, retry_backoff=1.0,
+                 hedge=False, hedge_quantile=0.95, retry_failed=True,
+                 shard=False, shard_lease_ttl=120.0, shard_batch_size=8, worker_id=None):
+        self.model = model
+        self.use_japanese = use_japanese
+        self.detail_level = detail_level
+        self.custom_prompt = custom_prompt
+        self.clean_custom_response = clean_custom_response
+        # 同時に送信するリクエスト数（OllamaのOLLAMA_NUM_PARALLELに合わせて設定）
+        self.max_workers = max(1, int(max_workers))
+        # 送信前の画像縮小・形式変換の設定（Noneの場合は元画像のまま送信）
+        self.max_image_edge = max_image_edge
+        self.max_image_pixels = max_image_pixels
+        self.image_format = image_format
+        self.image_quality = image_quality
+        # 推論中に先読みしてエンコードしておく画像数（0の場合はワーカースレッド内でエンコード）
+        self.prefetch_count = max(0, int(prefetch_count))
+        self.encode_workers = encode_workers
+        # Ollamaサーバー（複数指定した場合は負荷分散する）
+        self.endpoints = [url.rstrip('/') for url in (endpoints or ["http://localhost:11434"])]
+        self.base_url = self.endpoints[0]
+        self.api_url = f"{self.base_url}/api/generate"
+        self.supported_formats = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+        # 接続・受信の待ち時間の上限（秒）と、一時的なエラー（接続失敗・タイムアウト・5xx・429）の再試行
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max(0, int(max_retries))
+        self.retry_backoff = retry_backoff
+        # 応答が直近のp95より遅いリクエストには重複リクエストを送り、先に返った方を使う
+        self.hedge = hedge
+        if not 0 < hedge_quantile <= 1:
+            raise ValueError(f"重複リクエストの分位点は0より大きく1以下で指定してください: {hedge_quantile}")
+        self.hedge_quantile = hedge_quantile
+        self.request_latency = LatencyWindow()
+        self._hedge_executor = None
+        self._hedge_lock = Lock()
+        self.hedge_stats = {'sent': 0, 'won': 0}
+        # 失敗した画像を実行の最後にもう一度処理する
+        self.retry_failed = retry_failed
+        # 複数ノードで同じ共有フォルダを分担する（リースファイルで画像ごとに1台だけが処理する）
+        self.shard = shard
+        self.shard_lease_ttl = shard_lease_ttl
+        self.shard_batch_size = max(1, int(shard_batch_size))
+        self.worker_id = (worker_id or ShardLeases.default_worker_id()) if shard else worker_id
+        self.session = self.create_session()
+        self.balancer = None
+        if len(self.endpoints) > 1:
+            self.balancer = EndpointBalancer(self.endpoints, probe=self.is_ollama_running)
+        self._ollama_lock = Lock()
+        # 同じ画像・同じ設定の結果を再利用するキャッシュ（cache_path未指定時は無効）
+        self.cache = ResultCache(cache_path, cache_max_entries, cache_max_age_days) if cache_path else None
+        # 同じ設定で処理済みの画像をスキップし、中断したバッチを途中から再開する
+        self.incremental = incremental
+        # 探索範囲（サブフォルダを辿るか、対象・除外するファイルのglobパターン）
+        self.recursive = recursive
+        self.include_patterns = list(include_patterns or [])
+        self.exclude_patterns = list(exclude_patterns or [])
+        # ストリーミング生成と打ち切り条件（max_sentences未指定時は詳細度に応じた文数で打ち切る）
+        self.stream = stream
+        self.max_sentences = max_sentences
+        self.max_tags = max_tags
+        self.num_predict = num_predict
+        # モデルの常駐時間（例: "30m"、-1で無期限）と生成オプション
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.temperature = temperature
+        # バッチ開始前にモデルの存在確認と読み込みを済ませる
+        self.warmup = warmup
+        # 段階別の処理時間の記録と、レポートの書き出し先（json または prometheus）
+        self.perf = PerfRecorder()
+        self.metrics_path = metrics_path
+        self.metrics_format = metrics_format
+        # 結果の出力先（txt: 画像ごとの.txt / jsonl・sqlite: 1つのファイルにまとめて保存）
+        if output_sink not in OUTPUT_SINKS:
+            raise ValueError(f"不明な出力形式です: {output_sink}")
+        self.output_sink = output_sink
+        self.output_path = output_path
+        self.sink_batch_size = sink_batch_size
+        # 類似画像（縮小コピー・形式変換など）は代表画像の結果を再利用する（dHashのハミング距離で判定）
+        self.dedup = dedup
+        self.dedup_distance = dedup_distance
+        # 複数のプロンプト設定を指定すると、1回のエンコードで各設定の結果をまとめて生成する
+        self.profiles = [p if isinstance(p, PromptProfile) else PromptProfile(**p) for p in profiles or []]
+        names = [p.name for p in self.profiles]
+        if len(self.profiles) > 1 and (None in names or len(set(names)) != len(names)):
+            raise ValueError("複数のプロンプト設定を使う場合は、それぞれに異なる名前（出力の接尾辞）を付けてください")
+        self.last_summary = {}
+
+    def close(self):
+        """HTTPセッションとキャッシュを閉じる"""
+        if self.balancer:
+            self.balancer.stop()
+        if self._hedge_executor:
+            self._hedge_executor.shutdown(wait=True)
+        self.session.close()
+        if self.cache:
+            self.cache.close()
+
+    def create_session(self):
+        """Keep-Aliveで接続を再利用するHTTPセッションを作成する"""
+        import requests
+
+        session = requests.Session()
+        # 同時リクエスト数に合わせてコネクションプールを確保
+        # （ヘッジを使う場合は重複リクエストの分も確保する）
+        pool_size = self.max_workers * 2 if self.hedge else self.max_workers
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def is_ollama_running(self, base_url=None):
+        """Ollamaが応答するかを確認する"""
+        import requests
+
+        try:
+            response = self.session.get(f"{base_url or self.base_url}/api/tags", timeout=10)
+            return response.status_code == 200
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return False
+
+    def ensure_ollama(self):
+        """Ollamaが起動していない場合は起動を試みる（バッチ開始時や接続失敗時に呼ぶ）"""
+        if self.balancer:
+            # 複数サーバーの場合は起動せず、応答するサーバーだけをローテーションに入れる
+            healthy_count = self.balancer.probe_all()
+            if healthy_count == 0:
+                raise Exception("応答するOllamaサーバーがありません")
+            logger.info(f"Ollamaサーバー: {healthy_count}/{len(self.endpoints)}台が応答しています")
+            self.balancer.start()
+            return
+        # 複数のワーカーが同時に接続失敗しても起動処理は1回にまとめる
+        with self._ollama_lock:
+            if not self.start_ollama():
+                raise Exception("Ollamaの起動に失敗しました")
+
+    def start_ollama(self):
+        """Ollamaを起動する"""
+        try:
+            # Ollamaの状態をチェック
+            if self.is_ollama_running():
+                logger.info("Ollamaは既に起動しています")
+                return True
+
+            logger.info("Ollamaを起動しています...")
+            # PowerShellでバックグラウンド実行
+            subprocess.Popen(['powershell', 'Start-Process', 'ollama', 'serve'], 
+                           creationflags=subprocess.CREATE_NO_WINDOW)
+
+            # Ollamaが起動するまで待機
+            max_attempts = 30
+            for _ in range(max_attempts):
+                if self.is_ollama_running():
+                    logger.info("Ollama起動完了")
+                    return True
+                time.sleep(1)
+
+            logger.error("Ollamaの起動がタイムアウトしました")
+            return False
+        except Exception as e:
+            logger.error(f"Ollamaの起動中にエラーが発生しました: {str(e)}")
+            return False
+
+    def encode_options(self):
+        """encode_image_fileに渡す前処理の設定"""
+        return {
+            'max_edge': self.max_image_edge,
+            'max_pixels': self.max_image_pixels,
+            'target_format': self.image_format,
+            'quality': self.image_quality
+        }
+
+    def encode_image(self, image_path):
+        """画像を送信用のImagePayloadにする（変換が不要なら元のファイルをそのまま使う）"""
+        try:
+            return encode_image_file(image_path, **self.encode_options())
+        except Exception as e:
+            logger.error(f"画像のエンコード中にエラーが発生しました: {str(e)}")
+            raise
+
+    def prompt_profiles(self):
+        """使用するプロンプト設定の一覧（未指定ならコンストラクタの言語・詳細度などから作る）"""
+        if self.profiles:
+            return self.profiles
+        return [PromptProfile(None, self.use_japanese, self.detail_level, self.custom_prompt, self.clean_custom_response)]
+
+    def get_prompt(self, profile=None):
+        """プロンプトを生成"""
+        return (profile or self.prompt_profiles()[0]).prompt()
+
     def clean_response(self, response):
         """レスポンスから不要なテキストを削除し、画像の説明のみを残す"""
-        # 1. 初期クリーニング：不要な前置き表現の削除
-        patterns = [
-            r"^Here’s a description of the image in 2, ",
-            r"^説明[:：]\s*",
-            r"^Here's .*?:",
-            r"^This image shows",
-            r"^The image shows",
-            r"^In this image,",
-            r"^The image depicts",
-            r"^This image depicts",
-            r"^The photo shows",
-            r"^The picture shows",
-            r"^I will describe",
-            r"^I'll describe",
-            r"^Let me describe",
-            r"^I can see",
-            r"^画像には",
-            r"^この画像には",
-            r"^この画像は",
-            r"^写真には",
-            r"^画像は",
-            r"^この画像を.*?で説明します。?\n?",
-            r"^以下.*?で説明します。?\n?",
-            r"^、"
-        ]
-        
-        text = response.strip()
-        for pattern in patterns:
-            text = re.sub(pattern, "", text, flags=re.IGNORECASE).strip()
-    
-        # 2. 追加のクリーニング：一般的な接続表現や余計な表現の削除
-        additional_patterns = [
-            r"^また、?",
-            r"^そして、?",
-            r"^なお、?",
-            r"^さらに、?",
-            r"^加えて、?",
-            r"^特に、?",
-            r"^具体的には、?",
-            r"^Additionally,\s*",
-            r"^Moreover,\s*",
-            r"^Furthermore,\s*",
-            r"^Also,\s*",
-            r"^And\s*",
-            r"^Specifically,\s*",
-            r"^There\s+(?:is|are)\s+",
-            r"^We\s+can\s+see\s+",
-            r"^You\s+can\s+see\s+",
-            r"^It\s+appears\s+",
-            r"これは",
-            r"それは",
-            r"以下は",
-            r"次のような",
-            r"(?:以下の)?(?:画像に適用できる)?(?:Danbooru|だんぼーる|ダンボール|ダンボーる)?タグ(?:です|となります)。?\n?",
-            r"タグ(?:一覧|リスト)：\n?",
-            r"^[*＊・]",  # 行頭の箇条書き記号
-            r"^、",      # 行頭の読点
-            r"主な(?:特徴|要素)(?:：|は)(?:以下の)?(?:通り|とおり)(?:です)?。?\n?",
-        ]
-        
-        for pattern in additional_patterns:
-            text = re.sub(pattern, "", text, flags=re.IGNORECASE).strip()
-    
-        # 3. テキストを1行に整形：改行や箇条書き記号をカンマに変換
-        text = re.sub(r'[・\-•*＊\n] ?', ', ', text)
-        parts = [part.strip() for part in text.split(',')]
-        parts = [part for part in parts if part and not part.startswith('、')]
-        text = ', '.join(parts)
-    
-        # 4. カテゴリラベルの削除：例 "General:" や "Style/Art:" など
-        segments = [seg.strip() for seg in text.split(',')]
-        cleaned_segments = []
-        for seg in segments:
-            # セグメントが英数字、"/", "-"、スペースのみで構成され、末尾がコロンの場合はラベルと判断
-            if re.match(r'^[A-Za-z0-9/\- ]+:$', seg):
+        return RESPONSE_CLEANER.clean(response)
+
+
+    def settings_signature(self, profiles=None):
+        """モデル・プロンプト・クリーニング設定・前処理設定・生成設定・打ち切り条件を表す署名"""
+        signatures = []
+        for profile in profiles or self.prompt_profiles():
+            # ストリーミングで途中まで生成した結果を、打ち切らない実行で再利用しないよう条件を含める
+            limit = self.generation_limit(profile)
+            signatures.append(ResultCache.make_key(
+                self.model,
+                profile.prompt(),
+                profile.clean_custom_response,
+                sorted(self.encode_options().items()),
+                sorted(self.generation_options().items()),
+                (limit.max_sentences, limit.max_tags)
+            ))
+        return signatures[0] if len(signatures) == 1 else ResultCache.make_key(*signatures)
+
+    def output_signature(self):
+        """出力先の種類と場所を表す署名（出力先を変えた場合に処理済みとみなさないため）"""
+        output_path = str(Path(self.output_path).resolve()) if self.output_path else ""
+        return ResultCache.make_key(self.output_sink, output_path)
+
+    def generation_options(self):
+        """Ollamaに渡す生成オプション"""
+        options = {}
+        if self.num_predict:
+            options['num_predict'] = self.num_predict
+        if self.num_ctx:
+            options['num_ctx'] = self.num_ctx
+        if self.temperature is not None:
+            options['temperature'] = self.temperature
+        return options
+
+    def warmup_model(self):
+        """全サーバーでモデルの存在を確認して読み込み、かかった時間（秒）を返す"""
+        base_urls = self.endpoints
+        if self.balancer:
+            base_urls = [e.base_url for e in self.balancer.endpoints if e.healthy]
+        start_time = time.perf_counter()
+        # サーバーごとの読み込みは並行して行う
+        with ThreadPoolExecutor(max_workers=len(base_urls)) as executor:
+            for base_url, load_seconds in zip(base_urls, executor.map(self.load_model, base_urls)):
+                logger.info(f"モデル読み込み完了: {self.model} @ {base_url} ({load_seconds:.2f}秒)")
+        return time.perf_counter() - start_time
+
+    def load_model(self, base_url):
+        """/api/showでモデルの存在を確認し、空のリクエストでメモリに読み込む"""
+        start_time = time.perf_counter()
+        response = self.session.post(f"{base_url}/api/show", json={"model": self.model, "name": self.model},
+                                     timeout=self.request_timeout())
+        if response.status_code == 404:
+            raise ValueError(f"モデルが見つかりません: {self.model}（ollama pull {self.model} でダウンロードしてください）")
+        response.raise_for_status()
+
+        # プロンプトなしの生成リクエストはモデルの読み込みだけを行う
+        payload = {"model": self.model, "stream": False}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        options = self.generation_options()
+        if options:
+            payload["options"] = options
+        response = self.session.post(f"{base_url}/api/generate", json=payload, timeout=self.request_timeout())
+        response.raise_for_status()
+        return time.perf_counter() - start_time
+
+    def generation_limit(self, profile=None):
+        """ストリーミング時の打ち切り条件を作る"""
+        if not self.stream:
+            return GenerationLimit()
+        profile = profile or self.prompt_profiles()[0]
+        max_sentences = self.max_sentences
+        if max_sentences is None and not profile.custom_prompt:
+            max_sentences = DETAIL_SENTENCE_LIMITS.get(profile.detail_level)
+        return GenerationLimit(max_sentences=max_sentences, max_tags=self.max_tags)
+
+    def request_timeout(self):
+        """requestsに渡す (接続, 受信) のタイムアウト"""
+        return (self.connect_timeout, self.read_timeout)
+
+    @staticmethod
+    def is_retryable(error):
+        """時間をおけば成功する可能性があるエラーか（接続失敗・タイムアウト・5xx・429・正常なサーバーなし）"""
+        import requests
+
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, NoEndpointAvailable)):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            return error.response.status_code == 429 or error.response.status_code >= 500
+        return False
+
+    def request_generation(self, payload, profile=None, prefer=None):
+        """生成リクエストを送る（一時的なエラーは間隔を指数的に延ばしながら再試行する）
+
+        preferにサーバーのURLを渡すと、正常であればそのサーバーを優先する（会話の続きを同じサーバーで処理するため）。
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.hedge:
+                    return self.hedged_generation(payload, profile, prefer)
+                return self.send_generation(payload, profile, prefer)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    raise
+                # 同時に失敗したワーカーが一斉に再送しないよう、待ち時間にゆらぎを加える
+                delay = self.retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                logger.warning(f"生成リクエストに失敗しました。{delay:.1f}秒後に再試行します（{attempt}/{self.max_retries}）: {str(e)}")
+                time.sleep(delay)
+
+    def hedged_generation(self, payload, profile=None, prefer=None):
+        """直近のp95を過ぎても応答が無ければ重複リクエストを送り、先に返った結果を使う
+
+        打ち切れるようにストリーミングで受信し、遅れた方は接続を閉じて生成を止める。
+        """
+        delay = self.request_latency.percentile(self.hedge_quantile)
+        if delay is None:
+            # 待ち時間を決めるだけの計測が無い間は通常どおり送る
+            return self.send_generation(payload, profile, prefer)
+
+        if self._hedge_executor is None:
+            with self._hedge_lock:
+                if self._hedge_executor is None:
+                    self._hedge_executor = ThreadPoolExecutor(max_workers=self.max_workers * 2)
+        payload = dict(payload, stream=True)
+        cancels = [CancelHandle()]
+        futures = [self._hedge_executor.submit(self.send_generation, payload, profile, prefer, cancels[0])]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            logger.info(f"応答が{delay:.1f}秒を超えたため重複リクエストを送信します")
+            with self._hedge_lock:
+                self.hedge_stats['sent'] += 1
+            cancels.append(CancelHandle())
+            futures.append(self._hedge_executor.submit(self.send_generation, payload, profile, None, cancels[1]))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                # 遅れた方のリクエストを打ち切る
+                for cancel in cancels:
+                    cancel.set()
+                if future is not futures[0]:
+                    with self._hedge_lock:
+                        self.hedge_stats['won'] += 1
+                return future.result()
+        raise error
+
+    def send_generation(self, payload, profile=None, prefer=None, cancel=None):
+        """生成リクエストを1回送る（複数サーバーの場合は空いているサーバーを選び、接続できなければ別のサーバーで再試行する）"""
+        import requests
+
+        start_time = time.perf_counter()
+        if not self.balancer:
+            try:
+                result = self.generate(payload, profile=profile, cancel=cancel)
+            except requests.exceptions.ConnectionError as e:
+                # 接続できない場合のみOllamaの起動を試みて再送する
+                logger.warning("Ollamaに接続できません。起動を確認します")
+                try:
+                    self.ensure_ollama()
+                except Exception as start_error:
+                    # 起動できなければ元の接続エラーを返し、呼び出し元の再試行（待ち時間あり）に任せる
+                    logger.warning(f"Ollamaを起動できませんでした: {str(start_error)}")
+                    raise e
+                result = self.generate(payload, profile=profile, cancel=cancel)
+            self.request_latency.add(time.perf_counter() - start_time)
+            return result
+
+        tried = set()
+        last_error = None
+        while True:
+            try:
+                endpoint = self.balancer.acquire(exclude=tried, prefer=prefer)
+            except NoEndpointAvailable:
+                # 全サーバーで失敗した場合は最後のエラーを返し、呼び出し元の再試行に任せる
+                if last_error is not None:
+                    raise last_error
+                raise
+            start_time = time.perf_counter()
+            try:
+                response_text, metrics = self.generate(payload, endpoint.base_url, profile, cancel)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # 応答しないサーバーはローテーションから外し、別のサーバーで再試行する
+                logger.warning(f"Ollamaサーバー {endpoint.base_url} への接続に失敗しました。別のサーバーで再試行します: {str(e)}")
+                self.balancer.release(endpoint, failed=True)
+                tried.add(endpoint)
+                last_error = e
                 continue
-            cleaned_segments.append(seg)
-        text = ', '.join(cleaned_segments)
-    
-        # 5. メタ情報の削除：タグ生成に関する補足文など不要な文を除去
-        segments = [seg.strip() for seg in text.split(',')]
-        filtered_segments = []
-        for seg in segments:
-            lower_seg = seg.lower()
-            if lower_seg.startswith("i've prioritized tags") or \
-               lower_seg.startswith("possible additional tags") or \
-               lower_seg.startswith("optional additional tags") or \
-               lower_seg.startswith("additional suggestions") or \
-               lower_seg.startswith("generated tags") or \
-               lower_seg.startswith("based on danbooru tagging conventions") or \
-               lower_seg.startswith("i have included tags that describe") or \
-               lower_seg.startswith("i selected tags to best capture") or \
-               lower_seg.startswith("i generated these tags using") or \
-               lower_seg.startswith("generated by ai") or \
-               lower_seg.startswith("metadata"):
+            except RequestCancelled:
+                self.balancer.release(endpoint)
+                raise
+            except Exception as e:
+                # エラーを返したサーバーは選ばれにくくし、一時的なエラーなら別のサーバーで再試行する
+                self.balancer.release(endpoint, elapsed=time.perf_counter() - start_time, errored=True)
+                if not self.is_retryable(e):
+                    raise
+                logger.warning(f"Ollamaサーバー {endpoint.base_url} がエラーを返しました。別のサーバーで再試行します: {str(e)}")
+                tried.add(endpoint)
+                last_error = e
                 continue
-            filtered_segments.append(seg)
-        text = ', '.join(filtered_segments)
-        
-        return text.strip()
+            elapsed = time.perf_counter() - start_time
+            self.balancer.release(endpoint, elapsed=elapsed)
+            self.request_latency.add(elapsed)
+            metrics['endpoint'] = endpoint.base_url
+            return response_text, metrics
 
+    def generate(self, payload, base_url=None, profile=None, cancel=None):
+        """/api/generate（messagesがある場合は/api/chat）を呼び出し、生成テキストと速度の情報を返す
 
-    def analyze_image(self, image_path):
-        """画像を分析して結果を返す"""
-        try:
-            # Ollamaが起動していない場合は起動を試みる
-            try:
-                response = requests.get("http://localhost:11434/api/tags")
-            except requests.exceptions.ConnectionError:
-                if not self.start_ollama():
-                    raise Exception("Ollamaの起動に失敗しました")
-
-            base64_image = self.encode_image(image_path)
-
-            payload = {
-                "model": self.model,
-                "prompt": self.get_prompt(),
-                "stream": False,
-                "images": [base64_image]
-            }
+        ストリーミング中にcancel（CancelHandle）がセットされると接続を閉じてRequestCancelledを送出する。
+        """
+        chat = 'messages' in payload
+        api_url = f"{base_url or self.base_url}/api/{'chat' if chat else 'generate'}"
+        start_time = time.perf_counter()
+        if not payload.get('stream'):
+            response = self.session.post(api_url, data=JsonBody(payload), headers=self.JSON_HEADERS,
+                                         timeout=self.request_timeout())
+            response.raise_for_status()
+            result = response.json()
+            if chat:
+                return result.get('message', {}).get('content', 'No analysis available'), self.generation_metrics(result)
+            return result.get('response', 'No analysis available'), self.generation_metrics(result)
 
-            response = requests.post(self.api_url, json=payload)
+        # NDJSONのチャンクを逐次読み、打ち切り条件を満たしたら接続を閉じて生成を止める
+        limit = self.generation_limit(profile)
+        text = ""
+        token_count = 0
+        first_token_time = None
+        final_chunk = {}
+        truncated = False
+        with self.session.post(api_url, data=JsonBody(payload), headers=self.JSON_HEADERS, stream=True,
+                               timeout=self.request_timeout()) as response:
             response.raise_for_status()
+            if cancel is not None:
+                cancel.attach(response)
+            try:
+                for line in response.iter_lines():
+                    if cancel is not None and cancel.is_set():
+                        raise RequestCancelled()
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if 'error' in chunk:
+                        raise Exception(chunk['error'])
+                    piece = chunk.get('message', {}).get('content', '') if chat else chunk.get('response', '')
+                    if piece:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                        token_count += 1
+                        text += piece
+                        cut_position = limit.feed(text) if limit else None
+                        if cut_position is not None:
+                            text = text[:cut_position]
+                            truncated = True
+                            break
+                    if chunk.get('done'):
+                        final_chunk = chunk
+                        break
+            except Exception:
+                # 打ち切りで接続を閉じられた場合の読み込みエラーは打ち切りとして扱う
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+                raise
+            finally:
+                if cancel is not None:
+                    cancel.detach()
 
-            result = response.json()
-            response_text = result.get('response', 'No analysis available')
+        metrics = self.generation_metrics(final_chunk)
+        if first_token_time is not None:
+            metrics['ttft'] = first_token_time - start_time
+            if 'tokens_per_sec' not in metrics:
+                # 打ち切った場合はサーバーの統計が無いため、受信したチャンク数から推定する
+                elapsed = time.perf_counter() - first_token_time
+                if elapsed > 0 and token_count > 1:
+                    metrics['tokens_per_sec'] = (token_count - 1) / elapsed
+        metrics['truncated'] = truncated
+        return text, metrics
 
-            # チェックボックス clean_custom_response の値に応じて
-            if not self.clean_custom_response:
-                # チェックが外れている場合はそのまま返す
-                return response_text
-            else:
-                # チェックが入っている場合は必ずクリーン処理を実施
-                return self.clean_response(response_text)
+    @staticmethod
+    def generation_metrics(result):
+        """サーバーが返すeval_count/eval_durationから生成速度を求める"""
+        metrics = {}
+        eval_count = result.get('eval_count')
+        eval_duration = result.get('eval_duration')
+        if eval_count and eval_duration:
+            metrics['eval_count'] = eval_count
+            metrics['tokens_per_sec'] = eval_count / (eval_duration / 1e9)
+        # サーバー側で計測された各段階の時間（ナノ秒）
+        for key, name in (('total_duration', 'server_total_sec'), ('load_duration', 'load_sec'),
+                          ('prompt_eval_duration', 'server_prompt_eval_sec'), ('eval_duration', 'server_eval_sec')):
+            if result.get(key):
+                metrics[name] = result[key] / 1e9
+        return metrics
+
+    def cache_key(self, image_hash, profile=None):
+        """画像内容のハッシュと生成設定からキャッシュキーを作る"""
+        return ResultCache.make_key(image_hash, self.settings_signature([profile] if profile else None))
+
+    @staticmethod
+    def log_generation_metrics(image_path, metrics):
+        """画像ごとの初回トークンまでの時間と生成速度をログに出す"""
+        details = []
+        if 'ttft' in metrics:
+            details.append(f"初回トークンまで {metrics['ttft']:.2f}秒")
+        if 'tokens_per_sec' in metrics:
+            details.append(f"{metrics['tokens_per_sec']:.1f} tokens/秒")
+        if metrics.get('truncated'):
+            details.append("打ち切り")
+        if metrics.get('load_sec', 0) >= 1.0:
+            # 1秒以上かかった場合はモデルがアンロードされていたとみなす（keep_aliveの延長を検討）
+            details.append(f"モデル再読み込み {metrics['load_sec']:.1f}秒")
+        if details:
+            logger.info(f"生成速度: {Path(image_path).name} ({', '.join(details)})")
+
+    def analyze_image(self, image_path, base64_image=None, record=None):
+        """画像を分析して結果を返す（エンコード済みの画像が渡された場合はそれを使う）
+
+        recordに辞書を渡すと、段階別の処理時間や送信サイズが書き込まれる。
+        複数のプロンプト設定がある場合は最初の設定の結果を返す。
+        """
+        return self.analyze_image_profiles(image_path, base64_image, record)[0][1]
+
+    def analyze_image_profiles(self, image_path, base64_image=None, record=None):
+        """画像を全プロンプト設定で分析し、(設定, 結果) のリストを返す
+
+        画像のエンコードは1回だけ行う。設定が複数ある場合は /api/chat で1つの会話として
+        続けて送り、画像を含む先頭部分をサーバー側のキャッシュで使い回す。
+        """
+        import requests
+
+        if record is None:
+            record = {}
+        profiles = self.prompt_profiles()
+        try:
+            # キャッシュに同じ画像・同じ設定の結果があればOllamaを呼ばずに返す
+            results = {}
+            cache_keys = {}
+            if self.cache:
+                record['image_hash'] = hash_file(image_path)
+                for profile in profiles:
+                    cache_keys[profile] = self.cache_key(record['image_hash'], profile)
+                    cached = self.cache.get(cache_keys[profile])
+                    if cached is not None:
+                        results[profile] = cached
+                if len(results) == len(profiles):
+                    logger.info(f"キャッシュを使用: {Path(image_path).name}")
+                    record['cached'] = True
+                    return [(profile, results[profile]) for profile in profiles]
+
+            if base64_image is None:
+                start_time = time.perf_counter()
+                base64_image = self.encode_image(image_path)
+                record['encode_sec'] = time.perf_counter() - start_time
+            record['payload_bytes'] = len(base64_image)
+
+            messages = []
+            endpoint = None
+            for profile in profiles:
+                if profile in results:
+                    continue
+                if len(profiles) == 1:
+                    payload = {
+                        "model": self.model,
+                        "prompt": profile.prompt(),
+                        "stream": self.stream,
+                        "images": [base64_image]
+                    }
+                else:
+                    # 画像は最初の発言にだけ付け、以降の設定は前の応答に続けて質問する
+                    message = {"role": "user", "content": profile.prompt()}
+                    if not messages:
+                        message["images"] = [base64_image]
+                    messages.append(message)
+                    payload = {"model": self.model, "messages": list(messages), "stream": self.stream}
+                if self.keep_alive is not None:
+                    payload["keep_alive"] = self.keep_alive
+                options = self.generation_options()
+                if options:
+                    payload["options"] = options
+
+                start_time = time.perf_counter()
+                response_text, metrics = self.request_generation(payload, profile, prefer=endpoint)
+                record['request_sec'] = record.get('request_sec', 0) + time.perf_counter() - start_time
+                endpoint = metrics.get('endpoint')
+                if messages:
+                    messages.append({"role": "assistant", "content": response_text})
+                # サーバー側の時間は設定ごとの合計、それ以外は最初の設定の値を記録する
+                for key, value in metrics.items():
+                    if key in ('server_total_sec', 'load_sec', 'server_prompt_eval_sec', 'server_eval_sec'):
+                        record[key] = record.get(key, 0) + value
+                    else:
+                        record.setdefault(key, value)
+                self.log_generation_metrics(image_path, metrics)
+
+                start_time = time.perf_counter()
+                # チェックボックス clean_custom_response の値に応じて
+                if not profile.clean_custom_response:
+                    # チェックが外れている場合はそのまま返す
+                    results[profile] = response_text
+                else:
+                    # チェックが入っている場合は必ずクリーン処理を実施
+                    results[profile] = self.clean_response(response_text)
+                record['clean_sec'] = record.get('clean_sec', 0) + time.perf_counter() - start_time
+
+                if profile in cache_keys:
+                    self.cache.put(cache_keys[profile], results[profile])
+            return [(profile, results[profile]) for profile in profiles]
 
         except requests.exceptions.RequestException as e:
             logger.error(f"API通信中にエラーが発生しました: {str(e)}")
@@ -249,58 +2001,439 @@ class ImageAnalyzer:
             raise
 
 
-    def process_directory(self, directory_path, progress_callback=None, stop_check=None):
-        """指定されたディレクトリ内の全画像を処理する"""
+    @staticmethod
+    def _matches_any(patterns, name, relative_path):
+        """ファイル名または相対パスがいずれかのglobパターンに一致するか"""
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(relative_path, p) for p in patterns)
+
+    def iter_image_files(self, directory):
+        """os.scandirで画像ファイルを逐次列挙する（recursive時はサブフォルダも辿る）"""
+        root = str(directory)
+        stack = [root]
+        while stack:
+            current = stack.pop()
+            subdirectories = []
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        relative_path = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                        if self.exclude_patterns and self._matches_any(self.exclude_patterns, entry.name, relative_path):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if self.recursive:
+                                    subdirectories.append(entry.path)
+                                continue
+                            if not entry.is_file():
+                                continue
+                        except OSError:
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in self.supported_formats:
+                            continue
+                        if self.include_patterns and not self._matches_any(self.include_patterns, entry.name, relative_path):
+                            continue
+                        yield Path(entry.path)
+            except OSError as e:
+                logger.warning(f"フォルダを読み込めませんでした: {current} ({str(e)})")
+            # 見つかった順にサブフォルダを辿る
+            stack.extend(reversed(subdirectories))
+
+    def create_sink(self, directory, on_commit=None):
+        """設定された出力先を作成する"""
+        sink_class, default_name = OUTPUT_SINKS[self.output_sink]
+        if default_name is None:
+            return sink_class(on_commit=on_commit)
+        if self.output_path:
+            output_path = self.output_path
+        elif self.shard:
+            # 共有フォルダ上の1つのファイルに複数ノードから書き込まないよう、ワーカーごとに分ける
+            stem, extension = default_name.split('.', 1)
+            output_path = Path(directory) / f"{stem}.{self.worker_id}.{extension}"
+        else:
+            output_path = Path(directory) / default_name
+        return sink_class(output_path, on_commit=on_commit, batch_size=self.sink_batch_size)
+
+    def process_image_file(self, image_path, encoded_future=None, sink=None, directory=None, dedup_index=None):
+        """1枚の画像を分析し、結果を出力先に保存して処理時間の記録を返す"""
+        logger.info(f"処理中: {image_path.name}")
+        record = {'image': str(image_path)}
+        image_start_time = time.perf_counter()
+
+        # 類似画像の代表が既にあれば、その分析結果を待って再利用する
+        representative = None
+        outputs = None
+        if dedup_index is not None:
+            start_time = time.perf_counter()
+            entry, distance = dedup_index.claim(image_path, perceptual_hash(image_path))
+            record['dedup_sec'] = time.perf_counter() - start_time
+            if distance is None:
+                representative = entry
+            else:
+                outputs = entry.wait()
+                if outputs is not None:
+                    record['duplicate_of'] = str(entry.image_path)
+                    record['duplicate_distance'] = distance
+                    logger.info(f"類似画像のため結果を再利用: {image_path.name} ← {entry.image_path.name} (距離 {distance})")
+
+        if outputs is None:
+            # 先読みエンコードの結果があればそれを使って画像を分析
+            base64_image = None
+            try:
+                # エンコードの失敗も代表画像の失敗として扱い、待っている類似画像を解放する
+                if encoded_future is not None:
+                    base64_image, record['encode_sec'] = encoded_future.result()
+                    record['encode_wait_sec'] = time.perf_counter() - image_start_time
+                outputs = self.analyze_image_profiles(image_path, base64_image=base64_image, record=record)
+            finally:
+                # 失敗した場合はNoneを渡し、待っている類似画像はそれぞれ自分で分析する
+                if representative is not None:
+                    representative.resolve(outputs)
+        elif encoded_future is not None:
+            encoded_future.cancel()
+
+        # 結果を出力先に保存（指定が無ければ同名のテキストファイル）
+        start_time = time.perf_counter()
+        if sink is None:
+            sink = TextFileSink()
+        metadata = {'image': str(image_path), 'model': self.model, 'created_at': time.time()}
+        if not isinstance(sink, TextFileSink):
+            # まとめて保存する場合はフォルダからの相対パスと画像のハッシュも残す
+            if directory is not None:
+                metadata['image'] = Path(image_path).relative_to(directory).as_posix()
+            metadata['image_hash'] = record.get('image_hash') or hash_file(image_path)
+        sink.write(image_path, outputs, metadata)
+        record['write_sec'] = time.perf_counter() - start_time
+        record['total_sec'] = time.perf_counter() - image_start_time
+
+        logger.info(f"分析完了: {sink.location(image_path, [profile for profile, _ in outputs])}")
+        return record
+
+    @staticmethod
+    def log_performance(performance):
+        """実行全体の性能サマリーをログに出す"""
+        if not performance['images']:
+            return
+        logger.info(
+            f"性能: {performance['images_per_sec']:.2f}枚/秒, "
+            f"平均送信サイズ {performance['payload_bytes_mean'] / 1024:.1f}KB"
+        )
+        for name, stage in performance['stages'].items():
+            logger.info(
+                f"  {name}: p50 {stage['p50']:.3f}秒 / p95 {stage['p95']:.3f}秒 / p99 {stage['p99']:.3f}秒"
+            )
+
+    def process_directory(self, directory_path, progress_callback=None, stop_check=None, count_callback=None):
+        """指定されたディレクトリ内の全画像を処理する
+
+        count_callbackには (完了数, 検出数, 探索完了フラグ) が渡される。
+        """
         directory = Path(directory_path)
         if not directory.exists():
             raise ValueError(f"指定されたディレクトリが存在しません: {directory_path}")
 
-        # 処理対象の画像ファイル数をカウント
-        image_files = [f for f in directory.iterdir() if f.suffix.lower() in self.supported_formats]
-        total_files = len(image_files)
-        
-        if total_files == 0:
-            raise ValueError("指定されたディレクトリに画像ファイルが見つかりません。")
-        
-        processed_count = 0
-        error_count = 0
-
-        for image_path in image_files:
-            if stop_check and stop_check():
-                logger.info("処理が停止されました")
-                break
-                
+        # 探索は別スレッドで進め、最初の画像が見つかり次第処理を始める
+        shard = None
+        if self.shard:
+            # 完了マーカーは設定と出力先ごとに分け、どちらかを変えた場合は全画像を処理し直す
+            shard_signature = ResultCache.make_key(self.settings_signature(), self.output_signature())
+            lease_directory = directory / ".tagollama_shard" / shard_signature[:16]
+            shard = ShardLeases(directory, lease_directory, self.worker_id, self.shard_lease_ttl)
+            # リースを取得した画像だけを処理し、先行して取得するのはshard_batch_size件までにする
+            discovery = FileDiscovery(shard.iter_claims(self.iter_image_files(directory)),
+                                      max_buffered=self.shard_batch_size)
+        else:
+            discovery = FileDiscovery(self.iter_image_files(directory))
+        manifest = None
+        sink = None
+        encode_executor = None
+        dedup_index = DuplicateIndex(self.dedup_distance) if self.dedup else None
+        duplicates = []
+        # 失敗した画像は最後にもう一度処理する（再試行で成功した画像はエラーから除く）
+        retry_queue = []
+        retry_images = collections.deque()
+        retried = 0
+        recovered = 0
+        hedge_stats_start = dict(self.hedge_stats)
+        counts = {'processed': 0, 'errors': 0, 'skipped': 0}
+        # 起動確認・モデル読み込み・推論処理それぞれにかかった時間（秒）
+        timings = {}
+        processing_start_time = None
+        stopped = False
+
+        def report_progress():
+            completed = sum(counts.values())
+            if progress_callback:
+                progress_callback(completed / discovery.discovered * 100)
+            if count_callback:
+                count_callback(completed, discovery.discovered, discovery.finished)
+
+        try:
+            # 分担時は他のワーカーが全画像を処理中だと最初の画像が見つかるまで時間がかかるため、
+            # 待つ間も停止要求を確認する
+            first_image = discovery.next(timeout=0.2)
+            while first_image is FileDiscovery.PENDING:
+                if stop_check and stop_check():
+                    logger.info("処理が停止されました")
+                    self.last_summary = dict(counts, discovered=discovery.discovered, stopped=True)
+                    return 0, 0
+                first_image = discovery.next(timeout=0.2)
+            if first_image is None and shard:
+                logger.info("処理する画像がありません（すべて処理済みです）")
+                self.last_summary = dict(counts, discovered=0, stopped=False)
+                return 0, 0
+            if first_image is None:
+                raise ValueError("指定されたディレクトリに画像ファイルが見つかりません。")
+
+            # Ollamaの起動確認はバッチ開始時に1回だけ行う
+            start_time = time.perf_counter()
+            self.ensure_ollama()
+            timings['startup_sec'] = time.perf_counter() - start_time
+            if self.warmup:
+                timings['model_load_sec'] = self.warmup_model()
+            processing_start_time = time.perf_counter()
+            if self.cache:
+                self.cache.reset_stats()
+            self.perf = PerfRecorder()
+
+            profiles = self.prompt_profiles()
+            signature = None
+            # 出力先への書き込みが確定した画像だけを処理済みとして記録する
+            commit_callbacks = []
+            if shard:
+                # 分担時は完了マーカーが処理済みの記録を兼ねる
+                commit_callbacks.append(shard.complete)
+            elif self.incremental:
+                manifest = RunManifest(directory)
+                signature = ResultCache.make_key(self.settings_signature(profiles), self.output_signature())
+                commit_callbacks.append(lambda image_paths: manifest.record(image_paths, signature))
+
+            def on_commit(image_paths):
+                for callback in commit_callbacks:
+                    callback(image_paths)
+
+            sink = self.create_sink(directory, on_commit=on_commit if commit_callbacks else None)
+
+            # 先読みする場合はデコード・エンコードをプロセスプールで推論と並行して行う
+            if self.prefetch_count > 0:
+                from concurrent.futures import ProcessPoolExecutor
+                encode_executor = ProcessPoolExecutor(max_workers=self.encode_workers)
+                # メモリ使用量は「実行中 + 先読み」の画像数で頭打ちになる
+                max_pending = self.max_workers + self.prefetch_count
+            else:
+                # 実行中に加えて待機させておくタスク数の上限（停止時はここに積まれた分をキャンセルする）
+                max_pending = self.max_workers * 2
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                pending = {}
+                while True:
+                    # 上限までタスクを投入
+                    waiting_for_discovery = False
+                    while not stopped and len(pending) < max_pending:
+                        if stop_check and stop_check():
+                            stopped = True
+                            break
+                        retry = bool(retry_images)
+                        if retry:
+                            image_path = retry_images.popleft()
+                        elif first_image is not None:
+                            image_path, first_image = first_image, None
+                        else:
+                            # 実行中のタスクがあれば待たずに結果の回収へ戻る
+                            # （分担時は他のワーカーが処理中の画像の完了待ちで時間がかかることがある）
+                            image_path = discovery.next(timeout=0 if pending else 0.2)
+                            waiting_for_discovery = image_path is FileDiscovery.PENDING
+                        if image_path is None or waiting_for_discovery:
+                            # 分担時は他のワーカーの完了を待つ前に自分の失敗分を再試行する
+                            # （失敗した画像のリースを持ったまま互いの完了を待つと、どちらも終わらない）
+                            if retry_queue and not pending and (image_path is None or shard):
+                                logger.info(f"失敗した画像を再試行します: {len(retry_queue)}件")
+                                retry_images.extend(retry_queue)
+                                retried += len(retry_queue)
+                                retry_queue.clear()
+                                waiting_for_discovery = False
+                                continue
+                            break
+                        if not retry and manifest and manifest.is_complete(image_path, signature, sink.output_paths(image_path, profiles)):
+                            # 同じ設定で処理済みの画像はスキップ
+                            counts['skipped'] += 1
+                            report_progress()
+                            continue
+                        encoded_future = None
+                        if encode_executor and not retry:
+                            encoded_future = encode_executor.submit(
+                                timed_call, encode_image_file, image_path, **self.encode_options()
+                            )
+                        future = executor.submit(
+                            self.process_image_file, image_path, encoded_future, sink, directory, dedup_index
+                        )
+                        pending[future] = (image_path, encoded_future, retry)
+
+                    if not pending:
+                        if waiting_for_discovery:
+                            # 手元の処理が無い間にバッファ中の結果を確定させる（分担時は完了マーカーが
+                            # 書かれないと、他のワーカーがこのノードのリースの完了を待ち続ける）
+                            try:
+                                sink.flush()
+                            except Exception as e:
+                                # 結果はバッファに残っているため、次回の書き込みか終了時に再試行する
+                                logger.warning(f"出力先への書き込みに失敗しました: {str(e)}")
+                            continue
+                        break
+
+                    # 停止要求に素早く反応できるよう、一定間隔で待機を抜ける
+                    done, _ = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        image_path, _, retry = pending.pop(future)
+                        if future.cancelled():
+                            continue
+                        try:
+                            record = future.result()
+                            self.perf.add(record)
+                            counts['processed'] += 1
+                            if retry:
+                                counts['errors'] -= 1
+                                recovered += 1
+                            if 'duplicate_of' in record:
+                                duplicates.append({
+                                    'image': record['image'],
+                                    'representative': record['duplicate_of'],
+                                    'distance': record['duplicate_distance']
+                                })
+                        except Exception as e:
+                            logger.error(f"ファイル {image_path.name} の処理中にエラーが発生しました: {str(e)}")
+                            if not retry:
+                                counts['errors'] += 1
+                            if not retry and self.retry_failed:
+                                retry_queue.append(image_path)
+                            elif shard:
+                                # 最終的に失敗した画像のリースはすぐに手放し、他のワーカーの待ちを解く
+                                shard.release([image_path])
+
+                        # プログレスバーの更新
+                        report_progress()
+
+                    if not stopped and stop_check and stop_check():
+                        stopped = True
+
+                    if stopped:
+                        if dedup_index is not None:
+                            # 代表画像の結果を待っている類似画像が停止を妨げないようにする
+                            dedup_index.stop()
+                        # 未着手のタスクをキャンセルし、実行中のものだけ完了を待つ
+                        for future, (_, encoded_future, _) in list(pending.items()):
+                            if future.cancel():
+                                pending.pop(future)
+                                if encoded_future is not None:
+                                    encoded_future.cancel()
+        finally:
+            if processing_start_time is not None:
+                timings['processing_sec'] = time.perf_counter() - processing_start_time
+            discovery.stop()
+            if encode_executor:
+                encode_executor.shutdown(wait=True, cancel_futures=True)
             try:
-                logger.info(f"処理中: {image_path.name}")
-                
-                # 画像を分析
-                analysis_result = self.analyze_image(image_path)
-                
-                # 結果をテキストファイルに保存
-                text_path = image_path.with_suffix('.txt')
-                with open(text_path, 'w', encoding='utf-8') as f:
-                    f.write(analysis_result)
-                
-                logger.info(f"分析完了: {text_path}")
-                processed_count += 1
-
-                # プログレスバーの更新
-                if progress_callback:
-                    progress = (processed_count + error_count) / total_files * 100
-                    progress_callback(progress)
+                if sink:
+                    # バッファに残った結果を確定させてから（完了記録が書かれる）マニフェストを閉じる
+                    sink.close()
+            finally:
+                if manifest:
+                    manifest.close()
+                if shard:
+                    # 完了しなかった画像（停止・エラー）のリースは手放し、他のワーカーが処理できるようにする
+                    shard.close()
 
-            except Exception as e:
-                logger.error(f"ファイル {image_path.name} の処理中にエラーが発生しました: {str(e)}")
-                error_count += 1
+        if stopped:
+            logger.info("処理が停止されました")
+        if counts['skipped']:
+            logger.info(f"処理済みのためスキップ: {counts['skipped']}件")
+        if self.cache:
+            logger.info(f"キャッシュ: ヒット {self.cache.hits}件 / ミス {self.cache.misses}件")
+        if shard:
+            logger.info(f"分担: ワーカー {shard.worker_id} がリースを取得 {shard.claimed}件（期限切れの引き継ぎ {shard.taken_over}件）")
+        if retried:
+            logger.info(f"再試行: {retried}件中 {recovered}件が成功しました")
+        hedges_sent = self.hedge_stats['sent'] - hedge_stats_start['sent']
+        hedges_won = self.hedge_stats['won'] - hedge_stats_start['won']
+        if hedges_sent:
+            logger.info(f"重複リクエスト: {hedges_sent}件送信 / うち{hedges_won}件が先に応答")
+        if dedup_index is not None:
+            logger.info(f"類似画像: 代表 {dedup_index.tree.size}件 / 結果を再利用 {len(duplicates)}件")
+
+        logger.info(
+            "所要時間: 起動確認 {:.2f}秒 / モデル読み込み {:.2f}秒 / 推論処理 {:.2f}秒".format(
+                timings.get('startup_sec', 0), timings.get('model_load_sec', 0), timings.get('processing_sec', 0)
+            )
+        )
+
+        self.last_summary = dict(counts, discovered=discovery.discovered, stopped=stopped, **timings)
+        performance = self.perf.summary(timings.get('processing_sec', 0))
+        self.last_summary['performance'] = performance
+        self.log_performance(performance)
+        if self.metrics_path:
+            self.perf.export(self.metrics_path, performance, self.metrics_format)
+            logger.info(f"性能レポートを書き出しました: {self.metrics_path}")
+        if self.balancer:
+            self.last_summary['endpoints'] = self.balancer.summary()
+            for base_url, endpoint_summary in self.last_summary['endpoints'].items():
+                logger.info(f"{base_url}: 完了 {endpoint_summary['completed']}件 / 失敗 {endpoint_summary['failures']}回")
+        if self.cache:
+            self.last_summary['cache_hits'] = self.cache.hits
+            self.last_summary['cache_misses'] = self.cache.misses
+        if dedup_index is not None:
+            self.last_summary['deduplicated'] = duplicates
+        if shard:
+            self.last_summary['shard'] = {
+                'worker': shard.worker_id,
+                'claimed': shard.claimed,
+                'taken_over': shard.taken_over
+            }
+        if retried:
+            self.last_summary['retried'] = retried
+            self.last_summary['recovered'] = recovered
+        if self.hedge:
+            self.last_summary['hedges_sent'] = hedges_sent
+            self.last_summary['hedges_won'] = hedges_won
+
+        return counts['processed'], counts['errors']
+
+class QueueLogHandler(logging.Handler):
+    """ログをキューに積むだけのハンドラー（GUIへの反映はメインループ側でまとめて行う）"""
+
+    def __init__(self, log_queue):
+        super().__init__()
+        self.log_queue = log_queue
+
+    def emit(self, record):
+        try:
+            self.log_queue.put_nowait(self.format(record))
+        except Exception:
+            self.handleError(record)
 
-        return processed_count, error_count
 
 class ImageAnalyzerGUI:
+    # ログ表示に残す最大行数（古い行から削除する）
+    MAX_LOG_LINES = 5000
+    # キューをGUIへ反映する間隔（ミリ秒）
+    UI_REFRESH_MS = 100
+    # 出力形式の表示名とImageAnalyzerのoutput_sink
+    OUTPUT_SINK_LABELS = [
+        ("テキスト（画像ごとの.txt）", "txt"),
+        ("JSONL（1ファイルにまとめる）", "jsonl"),
+        ("SQLite（1ファイルにまとめる）", "sqlite"),
+    ]
+
     def __init__(self):
+        load_tkinter()
         self.root = tk.Tk()
         self.root.title("画像分析ツール")
-        self.root.geometry("800x700")  # 高さを増やして新しい要素を収容
+        self.root.geometry("800x980")  # 高さを増やして新しい要素を収容
         self.stop_analysis = False
+
+        # ワーカースレッドからはキューと変数に書き込むだけにし、Tkの操作はメインループで行う
+        self.log_queue = queue.Queue()
+        self.ui_calls = queue.Queue()
+        self._pending_progress = None
+        self._pending_counts = None
         
         # メインフレーム
         main_frame = ttk.Frame(self.root, padding="10")
@@ -324,6 +2457,26 @@ class ImageAnalyzerGUI:
         )
         self.japanese_checkbox.pack(side="left", padx=(20, 0))
 
+        # 1回のエンコードで英語と日本語の両方を出力する
+        self.both_languages_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            model_frame,
+            text="日英両方（.en.txt / .ja.txt）",
+            variable=self.both_languages_var
+        ).pack(side="left", padx=(10, 0))
+
+        # 同時リクエスト数
+        ttk.Label(model_frame, text="同時リクエスト数:").pack(side="left", padx=(20, 0))
+        self.max_workers_var = tk.IntVar(value=1)
+        self.max_workers_spinbox = ttk.Spinbox(
+            model_frame,
+            from_=1,
+            to=32,
+            textvariable=self.max_workers_var,
+            width=5
+        )
+        self.max_workers_spinbox.pack(side="left", padx=5)
+
         # カスタムプロンプト
         prompt_frame = ttk.LabelFrame(main_frame, text="カスタムプロンプト（空白時はデフォルトプロンプトを使用）", padding=10)
         prompt_frame.pack(fill="x", pady=(0, 10))
@@ -368,6 +2521,104 @@ class ImageAnalyzerGUI:
                 variable=self.detail_level_var
             ).pack(side="left", padx=10)
 
+        # 画像の前処理（送信前の縮小・形式変換）
+        preprocess_frame = ttk.LabelFrame(main_frame, text="画像の前処理（大きな画像を縮小して送信を高速化）", padding=10)
+        preprocess_frame.pack(fill="x", pady=(0, 10))
+
+        ttk.Label(preprocess_frame, text="最大辺(px):").pack(side="left")
+        self.max_edge_var = tk.StringVar(value="なし")
+        ttk.Combobox(
+            preprocess_frame,
+            textvariable=self.max_edge_var,
+            values=["なし", "512", "768", "1024", "1536", "2048"],
+            width=8
+        ).pack(side="left", padx=5)
+
+        ttk.Label(preprocess_frame, text="変換形式:").pack(side="left", padx=(20, 0))
+        self.image_format_var = tk.StringVar(value="元の形式")
+        ttk.Combobox(
+            preprocess_frame,
+            textvariable=self.image_format_var,
+            values=["元の形式", "JPEG", "WEBP", "PNG"],
+            state="readonly",
+            width=10
+        ).pack(side="left", padx=5)
+
+        ttk.Label(preprocess_frame, text="品質:").pack(side="left", padx=(20, 0))
+        self.image_quality_var = tk.IntVar(value=85)
+        ttk.Spinbox(
+            preprocess_frame,
+            from_=10,
+            to=100,
+            textvariable=self.image_quality_var,
+            width=5
+        ).pack(side="left", padx=5)
+
+        ttk.Label(preprocess_frame, text="先読み数:").pack(side="left", padx=(20, 0))
+        self.prefetch_count_var = tk.IntVar(value=0)
+        ttk.Spinbox(
+            preprocess_frame,
+            from_=0,
+            to=64,
+            textvariable=self.prefetch_count_var,
+            width=5
+        ).pack(side="left", padx=5)
+
+        # 実行オプション
+        run_options_frame = ttk.LabelFrame(main_frame, text="実行オプション", padding=10)
+        run_options_frame.pack(fill="x", pady=(0, 10))
+
+        self.use_cache_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            run_options_frame,
+            text="結果キャッシュを使用（同じ画像・同じ設定の再分析を省略）",
+            variable=self.use_cache_var
+        ).pack(side="left")
+
+        self.incremental_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            run_options_frame,
+            text="処理済みの画像をスキップ（中断した処理を再開）",
+            variable=self.incremental_var
+        ).pack(side="left", padx=(20, 0))
+
+        self.stream_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            run_options_frame,
+            text="ストリーミング生成（詳細度の文数で打ち切り）",
+            variable=self.stream_var
+        ).pack(side="left", padx=(20, 0))
+
+        # 出力形式・類似画像の結果再利用
+        output_frame = ttk.LabelFrame(main_frame, text="出力", padding=10)
+        output_frame.pack(fill="x", pady=(0, 10))
+
+        ttk.Label(output_frame, text="出力形式:").pack(side="left")
+        self.output_sink_var = tk.StringVar(value=self.OUTPUT_SINK_LABELS[0][0])
+        ttk.Combobox(
+            output_frame,
+            textvariable=self.output_sink_var,
+            values=[label for label, _ in self.OUTPUT_SINK_LABELS],
+            state="readonly",
+            width=30
+        ).pack(side="left", padx=5)
+
+        self.dedup_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            output_frame,
+            text="類似画像は結果を再利用　距離:",
+            variable=self.dedup_var
+        ).pack(side="left", padx=(20, 0))
+
+        self.dedup_distance_var = tk.IntVar(value=4)
+        ttk.Spinbox(
+            output_frame,
+            from_=0,
+            to=16,
+            textvariable=self.dedup_distance_var,
+            width=5
+        ).pack(side="left", padx=5)
+
         # フォルダ選択
         folder_frame = ttk.LabelFrame(main_frame, text="フォルダ選択", padding=10)
         folder_frame.pack(fill="x", pady=(0, 10))
@@ -379,6 +2630,25 @@ class ImageAnalyzerGUI:
         browse_button = ttk.Button(folder_frame, text="参照", command=self.browse_folder, style='Accent.TButton')
         browse_button.pack(side="left", padx=5)
 
+        # 探索範囲（サブフォルダ・対象/除外パターン）
+        scan_frame = ttk.LabelFrame(main_frame, text="探索範囲（パターンはカンマ区切りのglob。例: *.png, raw/*）", padding=10)
+        scan_frame.pack(fill="x", pady=(0, 10))
+
+        self.recursive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            scan_frame,
+            text="サブフォルダも処理",
+            variable=self.recursive_var
+        ).pack(side="left")
+
+        ttk.Label(scan_frame, text="対象:").pack(side="left", padx=(20, 0))
+        self.include_patterns_var = tk.StringVar()
+        ttk.Entry(scan_frame, textvariable=self.include_patterns_var, width=20).pack(side="left", padx=5)
+
+        ttk.Label(scan_frame, text="除外:").pack(side="left", padx=(20, 0))
+        self.exclude_patterns_var = tk.StringVar()
+        ttk.Entry(scan_frame, textvariable=self.exclude_patterns_var, width=20).pack(side="left", padx=5)
+
         # プログレス情報
         progress_frame = ttk.LabelFrame(main_frame, text="進捗状況", padding=10)
         progress_frame.pack(fill="x", pady=(0, 10))
@@ -393,6 +2663,9 @@ class ImageAnalyzerGUI:
         )
         self.progress_bar.pack(fill="x", padx=5)
 
+        self.count_var = tk.StringVar(value="")
+        ttk.Label(progress_frame, textvariable=self.count_var).pack(anchor="w", padx=5, pady=(5, 0))
+
         # ログ表示エリア
         log_frame = ttk.LabelFrame(main_frame, text="ログ", padding=10)
         log_frame.pack(fill="both", expand=True, pady=(0, 10))
@@ -445,12 +2718,17 @@ class ImageAnalyzerGUI:
         self.append_log("※ Ollamaが起動していない場合は自動的に起動を試みます")
         self.append_log("1. Ollamaモデルを確認してください")
         self.append_log("2. 必要に応じて日本語出力を選択してください")
+        self.append_log("   （OLLAMA_NUM_PARALLELを設定している場合は同時リクエスト数を増やすと高速化できます）")
         self.append_log("3. 必要に応じてカスタムプロンプトを入力してください")
         self.append_log("4. カスタムプロンプトが空の場合、説明の詳細度を選択してください")
         self.append_log("5. 画像フォルダを選択してください")
         self.append_log("6. [画像分析実行]ボタンをクリックして処理を開始してください")
         self.append_log("\nサポートされている画像形式: jpg, jpeg, png, gif, bmp, webp")
 
+        # ログをGUIに表示するためのハンドラーは起動時に1回だけ登録する
+        logger.addHandler(QueueLogHandler(self.log_queue))
+        self.root.after(self.UI_REFRESH_MS, self.process_ui_queue)
+
     def browse_folder(self):
         folder_path = filedialog.askdirectory()
         if folder_path:
@@ -458,13 +2736,61 @@ class ImageAnalyzerGUI:
             self.append_log(f"フォルダが選択されました: {folder_path}")
 
     def update_progress(self, value):
-        self.progress_var.set(value)
-        self.root.update_idletasks()
+        # 最新の値だけを保持し、次の画面更新でまとめて反映する
+        self._pending_progress = value
+
+    def update_counts(self, completed, discovered, discovery_finished):
+        self._pending_counts = (completed, discovered, discovery_finished)
+
+    def call_in_ui(self, func, *args):
+        """ワーカースレッドからTkの操作をメインループに依頼する"""
+        self.ui_calls.put((func, args))
+
+    def process_ui_queue(self):
+        """溜まったログ・進捗・UI操作をまとめて反映する（root.afterで定期的に呼ばれる）"""
+        try:
+            messages = []
+            while True:
+                try:
+                    messages.append(self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if messages:
+                # 表示しきれない古いログは挿入せずに捨てる
+                messages = messages[-self.MAX_LOG_LINES:]
+                self.log_text.insert(tk.END, "\n".join(messages) + "\n")
+                line_count = int(self.log_text.index("end-1c").split(".")[0])
+                if line_count > self.MAX_LOG_LINES:
+                    self.log_text.delete("1.0", f"{line_count - self.MAX_LOG_LINES + 1}.0")
+                self.log_text.see(tk.END)
+
+            progress, self._pending_progress = self._pending_progress, None
+            if progress is not None:
+                self.progress_var.set(progress)
+            counts, self._pending_counts = self._pending_counts, None
+            if counts is not None:
+                completed, discovered, discovery_finished = counts
+                suffix = "" if discovery_finished else "（探索中）"
+                self.count_var.set(f"完了: {completed} / 検出: {discovered}{suffix}")
+
+            while True:
+                try:
+                    func, args = self.ui_calls.get_nowait()
+                except queue.Empty:
+                    break
+                func(*args)
+        finally:
+            # 反映中に例外が起きても、以降のログや進捗の表示が止まらないよう次回の呼び出しを予約する
+            self.root.after(self.UI_REFRESH_MS, self.process_ui_queue)
+
+    @staticmethod
+    def split_patterns(text):
+        """カンマ区切りのパターン文字列をリストに変換する"""
+        return [pattern.strip() for pattern in text.split(",") if pattern.strip()]
 
     def append_log(self, message):
-        self.log_text.insert(tk.END, f"{message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        # どのスレッドから呼ばれても安全なように、キューに積んで次の画面更新で表示する
+        self.log_queue.put(message)
 
     def stop_analysis_handler(self):
         """分析処理を停止する"""
@@ -479,40 +2805,62 @@ class ImageAnalyzerGUI:
             self.append_log("エラー: フォルダを選択してください。")
             return
 
+        # 設定値はメインスレッドで読み取ってからワーカースレッドに渡す
+        try:
+            custom_prompt = self.custom_prompt.get("1.0", tk.END).strip()
+            max_edge = self.max_edge_var.get().strip()
+            image_format = self.image_format_var.get()
+            analyzer_options = dict(
+                model=self.model_var.get(),
+                use_japanese=self.use_japanese_var.get(),
+                detail_level=self.detail_level_var.get(),
+                custom_prompt=custom_prompt if custom_prompt else None,
+                clean_custom_response=self.clean_custom_response_var.get(),
+                max_workers=self.max_workers_var.get(),
+                max_image_edge=int(max_edge) if max_edge.isdigit() else None,
+                image_format=None if image_format == "元の形式" else image_format,
+                image_quality=self.image_quality_var.get(),
+                prefetch_count=self.prefetch_count_var.get(),
+                cache_path=DEFAULT_CACHE_PATH if self.use_cache_var.get() else None,
+                incremental=self.incremental_var.get(),
+                recursive=self.recursive_var.get(),
+                include_patterns=self.split_patterns(self.include_patterns_var.get()),
+                exclude_patterns=self.split_patterns(self.exclude_patterns_var.get()),
+                stream=self.stream_var.get(),
+                output_sink=dict(self.OUTPUT_SINK_LABELS)[self.output_sink_var.get()],
+                dedup=self.dedup_var.get(),
+                dedup_distance=self.dedup_distance_var.get()
+            )
+            if self.both_languages_var.get():
+                analyzer_options['profiles'] = [
+                    PromptProfile(name, use_japanese, analyzer_options['detail_level'],
+                                  analyzer_options['custom_prompt'], analyzer_options['clean_custom_response'])
+                    for name, use_japanese in (("en", False), ("ja", True))
+                ]
+        except (tk.TclError, ValueError) as e:
+            self.append_log(f"エラー: 設定値が正しくありません: {str(e)}")
+            return
+
         self.stop_analysis = False
         self.run_button.config(state="disabled")  # 実行中はボタンを無効化
         self.stop_button.config(state="normal")  # 停止ボタンを有効化
         self.progress_var.set(0)  # プログレスバーをリセット
-
-        # ログをGUIに表示するためのハンドラーを設定
-        class TextHandler(logging.Handler):
-            def __init__(self, gui):
-                super().__init__()
-                self.gui = gui
-
-            def emit(self, record):
-                msg = self.format(record)
-                self.gui.append_log(msg)
-
-        logger.addHandler(TextHandler(self))
+        self.count_var.set("")
+        self._pending_progress = None
+        self._pending_counts = None
 
         # 画像分析処理を別スレッドで実行
         def analysis_thread():
+            analyzer = None
             try:
                 # ImageAnalyzerインスタンスを作成
-                custom_prompt = self.custom_prompt.get("1.0", tk.END).strip()
-                analyzer = ImageAnalyzer(
-                    model=self.model_var.get(),
-                    use_japanese=self.use_japanese_var.get(),
-                    detail_level=self.detail_level_var.get(),
-                    custom_prompt=custom_prompt if custom_prompt else None,
-                    clean_custom_response=self.clean_custom_response_var.get()
-                )
+                analyzer = ImageAnalyzer(**analyzer_options)
                 # ディレクトリ内の画像を処理
                 processed, errors = analyzer.process_directory(
                     folder_path,
                     progress_callback=self.update_progress,  # プログレスバーを更新するコールバック関数
-                    stop_check=lambda: self.stop_analysis  # 停止ボタンが押されたかチェックする関数
+                    stop_check=lambda: self.stop_analysis,  # 停止ボタンが押されたかチェックする関数
+                    count_callback=self.update_counts  # 完了数・検出数を表示するコールバック関数
                 )
                 if self.stop_analysis:
                     self.append_log("\n処理が停止されました:")
@@ -520,11 +2868,17 @@ class ImageAnalyzerGUI:
                     self.append_log("\n処理完了:")
                 self.append_log(f"処理された画像数: {processed}")
                 self.append_log(f"エラー数: {errors}")
+                if analyzer.last_summary.get('skipped'):
+                    self.append_log(f"スキップ数（処理済み）: {analyzer.last_summary['skipped']}")
+                if analyzer.cache:
+                    self.append_log(f"キャッシュヒット数: {analyzer.cache.hits} / ミス数: {analyzer.cache.misses}")
             except Exception as e:
                 self.append_log(f"エラーが発生しました: {str(e)}")
             finally:
-                self.run_button.config(state="normal")  # 実行ボタンを再度有効化
-                self.stop_button.config(state="disabled")  # 停止ボタンを無効化
+                if analyzer:
+                    analyzer.close()
+                self.call_in_ui(self.run_button.config, {"state": "normal"})  # 実行ボタンを再度有効化
+                self.call_in_ui(self.stop_button.config, {"state": "disabled"})  # 停止ボタンを無効化
                 self.stop_analysis = False  # 停止フラグをリセット
 
         Thread(target=analysis_thread, daemon=True).start()
@@ -532,9 +2886,263 @@ class ImageAnalyzerGUI:
     def run(self):
         self.root.mainloop()
 
-def main():
+def build_arg_parser():
+    """コマンドラインモードの引数を定義する"""
+    parser = argparse.ArgumentParser(
+        description="Ollamaで画像フォルダを一括分析します（引数なしで起動するとGUIモード）"
+    )
+    parser.add_argument("folder", help="分析する画像フォルダ")
+
+    prompt_group = parser.add_argument_group("プロンプト")
+    prompt_group.add_argument("--model", default="gemma3:27b", help="Ollamaモデル（既定: gemma3:27b）")
+    prompt_group.add_argument("--japanese", action="store_true", help="日本語で出力する")
+    prompt_group.add_argument("--detail", choices=["brief", "standard", "detailed"], default="standard",
+                              help="説明の詳細度（カスタムプロンプト使用時は無効）")
+    prompt_group.add_argument("--prompt", help="カスタムプロンプト")
+    prompt_group.add_argument("--prompt-file", help="カスタムプロンプトを読み込むファイル")
+    prompt_group.add_argument("--no-clean", action="store_true", help="前置きや余計な表現を削除しない")
+    prompt_group.add_argument("--profile", action="append", default=[], metavar="NAME[:KEY=VALUE,...]",
+                              help="出力ごとのプロンプト設定（複数指定で1回のエンコードからまとめて生成し、"
+                                   "image.NAME.txt に保存。KEYは lang=ja|en, detail, prompt-file, clean=on|off。"
+                                   "省略した項目は上のオプションの値）")
+
+    performance_group = parser.add_argument_group("パフォーマンス")
+    performance_group.add_argument("--workers", type=int, default=1, help="同時リクエスト数")
+    performance_group.add_argument("--prefetch", type=int, default=0, help="先読みしてエンコードしておく画像数")
+    performance_group.add_argument("--encode-workers", type=int, help="先読みエンコードのプロセス数")
+    performance_group.add_argument("--max-edge", type=int, help="送信前に縮小する最大辺(px)")
+    performance_group.add_argument("--max-pixels", type=int, help="送信前に縮小する最大画素数")
+    performance_group.add_argument("--image-format", choices=["JPEG", "WEBP", "PNG"], type=str.upper,
+                                   help="送信前に変換する画像形式")
+    performance_group.add_argument("--quality", type=int, default=85, help="JPEG/WEBPの品質")
+
+    performance_group.add_argument("--endpoint", action="append", default=[], metavar="URL",
+                                   help="OllamaサーバーのURL（複数指定で負荷分散。--workersは合計の同時リクエスト数）")
+
+    network_group = parser.add_argument_group("通信・再試行")
+    network_group.add_argument("--connect-timeout", type=float, default=10, help="接続のタイムアウト（秒）")
+    network_group.add_argument("--read-timeout", type=float, default=300,
+                               help="受信のタイムアウト（秒。ストリーミング時はチャンクの間隔）")
+    network_group.add_argument("--retries", type=int, default=2,
+                               help="接続失敗・タイムアウト・5xx・429の再試行回数（間隔は指数的に延ばす）")
+    network_group.add_argument("--retry-backoff", type=float, default=1.0, help="最初の再試行までの待ち時間（秒）")
+    network_group.add_argument("--hedge", action="store_true",
+                               help="直近のp95より応答が遅いリクエストに重複リクエストを送り、先に返った結果を使う")
+    network_group.add_argument("--hedge-quantile", type=float, default=0.95,
+                               help="重複リクエストを送るまでの待ち時間に使う分位点（既定: 0.95）")
+    network_group.add_argument("--no-retry-failed", action="store_true",
+                               help="失敗した画像を実行の最後に再処理しない")
+
+    generation_group = parser.add_argument_group("生成")
+    generation_group.add_argument("--stream", action="store_true",
+                                  help="ストリーミングで受信し、打ち切り条件を満たしたら生成を止める")
+    generation_group.add_argument("--max-sentences", type=int,
+                                  help="ストリーミング時に打ち切る文数（既定: 詳細度に応じて1/3/5文）")
+    generation_group.add_argument("--max-tags", type=int, help="ストリーミング時に打ち切るタグ数")
+    generation_group.add_argument("--num-predict", type=int, help="生成する最大トークン数（num_predict）")
+    generation_group.add_argument("--num-ctx", type=int, help="コンテキスト長（num_ctx）")
+    generation_group.add_argument("--temperature", type=float, help="生成の温度（temperature）")
+    generation_group.add_argument("--keep-alive",
+                                  help="リクエスト後にモデルを常駐させる時間（例: 30m、-1で無期限）")
+    generation_group.add_argument("--no-warmup", action="store_true",
+                                  help="開始前のモデル存在確認と読み込みを行わない")
+
+    run_group = parser.add_argument_group("実行")
+    run_group.add_argument("--cache", nargs="?", const=str(DEFAULT_CACHE_PATH),
+                           help=f"結果キャッシュを使用する（パス省略時: {DEFAULT_CACHE_PATH}）")
+    run_group.add_argument("--cache-max-entries", type=int, default=100000, help="キャッシュの最大件数")
+    run_group.add_argument("--cache-max-age-days", type=float, help="キャッシュの保持日数")
+    run_group.add_argument("--incremental", action="store_true", help="処理済みの画像をスキップして再開する")
+    run_group.add_argument("--dedup", action="store_true",
+                           help="類似画像（縮小コピー・形式変換など）は代表画像の結果を再利用する")
+    run_group.add_argument("--dedup-distance", type=int, default=4,
+                           help="類似とみなすdHash（64ビット）のハミング距離")
+    run_group.add_argument("--shard", action="store_true",
+                           help="同じ共有フォルダを複数のノードで分担する（リースファイルで画像ごとに1台だけが処理）")
+    run_group.add_argument("--lease-ttl", type=float, default=120,
+                           help="応答の無いワーカーのリースを引き継ぐまでの秒数")
+    run_group.add_argument("--shard-batch", type=int, default=8, help="先行してリースを取得する画像数")
+    run_group.add_argument("--worker-id", help="分担時のワーカー名（既定: ホスト名-プロセスID-乱数）")
+    run_group.add_argument("--recursive", action="store_true", help="サブフォルダも処理する")
+    run_group.add_argument("--include", action="append", default=[], metavar="GLOB", help="対象にするパターン（複数指定可）")
+    run_group.add_argument("--exclude", action="append", default=[], metavar="GLOB", help="除外するパターン（複数指定可）")
+
+    output_group = parser.add_argument_group("出力")
+    output_group.add_argument("--sink", choices=sorted(OUTPUT_SINKS), default="txt",
+                              help="結果の出力先（txt: 画像ごとの.txt / jsonl・sqlite: 1つのファイルにまとめる）")
+    output_group.add_argument("--output", metavar="PATH",
+                              help="jsonl/sqliteの出力ファイル（既定: 処理フォルダ内の tagollama_results.*）")
+    output_group.add_argument("--sink-batch", type=int, default=100,
+                              help="jsonl/sqliteにまとめて書き込む件数")
+    output_group.add_argument("--json", action="store_true",
+                              help="進捗とサマリーをJSON Lines形式で標準出力に出す")
+    output_group.add_argument("--quiet", action="store_true", help="警告以外のログを出さない")
+    output_group.add_argument("--metrics", metavar="PATH", help="画像ごとの処理時間と性能サマリーを書き出すファイル")
+    output_group.add_argument("--metrics-format", choices=["json", "prometheus"], default="json",
+                              help="性能レポートの形式（prometheusはnode_exporterのtextfile形式）")
+    return parser
+
+
+def parse_keep_alive(value):
+    """keep_aliveの指定を数値（秒）または期間文字列に変換する"""
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_profile(spec, defaults):
+    """--profile の指定（例: en:lang=en,detail=brief）をPromptProfileに変換する"""
+    name, _, options = spec.partition(':')
+    settings = dict(defaults, name=name.strip())
+    if not settings['name']:
+        raise ValueError(f"プロンプト設定に名前がありません: {spec}")
+    for option in filter(None, (item.strip() for item in options.split(','))):
+        key, _, value = option.partition('=')
+        if key == 'lang' and value in ('ja', 'en'):
+            settings['use_japanese'] = value == 'ja'
+        elif key == 'detail' and value in ('brief', 'standard', 'detailed'):
+            settings['detail_level'] = value
+        elif key == 'prompt-file':
+            settings['custom_prompt'] = Path(value).read_text(encoding='utf-8').strip() or None
+        elif key == 'clean' and value in ('on', 'off'):
+            settings['clean_custom_response'] = value == 'on'
+        else:
+            raise ValueError(f"プロンプト設定の指定が正しくありません: {option}")
+    return PromptProfile(**settings)
+
+
+def analyzer_from_args(args):
+    """コマンドライン引数からImageAnalyzerを作成する"""
+    custom_prompt = args.prompt
+    if args.prompt_file:
+        custom_prompt = Path(args.prompt_file).read_text(encoding='utf-8')
+    # --profile で省略した項目はこれらの値を使う
+    prompt_settings = {
+        'use_japanese': args.japanese,
+        'detail_level': args.detail,
+        'custom_prompt': custom_prompt.strip() if custom_prompt and custom_prompt.strip() else None,
+        'clean_custom_response': not args.no_clean
+    }
+    return ImageAnalyzer(
+        model=args.model,
+        **prompt_settings,
+        max_workers=args.workers,
+        max_image_edge=args.max_edge,
+        max_image_pixels=args.max_pixels,
+        image_format=args.image_format,
+        image_quality=args.quality,
+        prefetch_count=args.prefetch,
+        encode_workers=args.encode_workers,
+        cache_path=args.cache,
+        cache_max_entries=args.cache_max_entries,
+        cache_max_age_days=args.cache_max_age_days,
+        incremental=args.incremental,
+        recursive=args.recursive,
+        include_patterns=args.include,
+        exclude_patterns=args.exclude,
+        stream=args.stream,
+        max_sentences=args.max_sentences,
+        max_tags=args.max_tags,
+        num_predict=args.num_predict,
+        endpoints=args.endpoint or None,
+        keep_alive=parse_keep_alive(args.keep_alive),
+        num_ctx=args.num_ctx,
+        temperature=args.temperature,
+        warmup=not args.no_warmup,
+        metrics_path=args.metrics,
+        metrics_format=args.metrics_format,
+        output_sink=args.sink,
+        output_path=args.output,
+        sink_batch_size=args.sink_batch,
+        dedup=args.dedup,
+        dedup_distance=args.dedup_distance,
+        profiles=[parse_profile(spec, prompt_settings) for spec in args.profile],
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        max_retries=args.retries,
+        retry_backoff=args.retry_backoff,
+        hedge=args.hedge,
+        hedge_quantile=args.hedge_quantile,
+        retry_failed=not args.no_retry_failed,
+        shard=args.shard,
+        shard_lease_ttl=args.lease_ttl,
+        shard_batch_size=args.shard_batch,
+        worker_id=args.worker_id
+    )
+
+
+def run_cli(argv):
+    """GUIを使わずにフォルダを処理する（終了コード: 0=成功, 1=エラーあり, 2=実行失敗, 130=停止）"""
+    args = build_arg_parser().parse_args(argv)
+    if args.quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    def emit(event, **fields):
+        if args.json:
+            print(json.dumps(dict(event=event, **fields), ensure_ascii=False), flush=True)
+
+    # Ctrl+C / SIGTERMでは実行中の画像を完了させてから停止する（2回目のCtrl+Cで強制終了）
+    stop_requested = Event()
+
+    def request_stop(signum, frame):
+        logger.info("停止要求を受け付けました。実行中の処理が完了するまでお待ちください...")
+        stop_requested.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, request_stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, request_stop)
+
+    def report_counts(completed, discovered, discovery_finished):
+        emit("progress", completed=completed, discovered=discovered, discovery_finished=discovery_finished)
+
+    analyzer = None
+    start_time = time.time()
+    try:
+        analyzer = analyzer_from_args(args)
+        processed, errors = analyzer.process_directory(
+            args.folder,
+            stop_check=stop_requested.is_set,
+            count_callback=report_counts
+        )
+    except Exception as e:
+        logger.error(f"エラーが発生しました: {str(e)}")
+        emit("error", message=str(e))
+        return 2
+    finally:
+        if analyzer:
+            analyzer.close()
+
+    summary = dict(analyzer.last_summary, elapsed_sec=round(time.time() - start_time, 3))
+    if args.json:
+        emit("summary", **summary)
+    else:
+        print(f"処理された画像数: {processed}")
+        print(f"エラー数: {errors}")
+        if summary.get('skipped'):
+            print(f"スキップ数（処理済み）: {summary['skipped']}")
+        if analyzer.cache:
+            print(f"キャッシュヒット数: {summary['cache_hits']} / ミス数: {summary['cache_misses']}")
+        print(f"経過時間: {summary['elapsed_sec']}秒")
+        if 'model_load_sec' in summary:
+            print(f"  うちモデル読み込み: {summary['model_load_sec']:.2f}秒 / 推論処理: {summary.get('processing_sec', 0):.2f}秒")
+
+    if summary['stopped']:
+        return 130
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    """引数があればコマンドラインモード、なければGUIモードで起動する"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_cli(argv)
     gui = ImageAnalyzerGUI()
     gui.run()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())